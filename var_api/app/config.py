@@ -3,8 +3,12 @@
 import os
 from pathlib import Path
 from dataclasses import dataclass, field
+from typing import Dict, Optional, Union
 import torch
 
+# Values of the ModelConfig dtype fields (None runs in float32)
+INFERENCE_DTYPES = {'float32': None, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
 @dataclass
 class ModelConfig:
     """VAR Model configuration"""
@@ -15,12 +19,45 @@ class ModelConfig:
     var_drop_path: float = 0.05
     var_attn_l2_norm: bool = True
     var_cond_drop: float = 0.0
+    # Attention backend: 'sdpa' (fused scaled_dot_product_attention) or 'math' (explicit softmax)
+    var_attn_backend: str = 'sdpa'
+    # Prompts whose stage-0 transformer state is kept for re-rolls (0 to disable)
+    var_prefix_cache_size: int = 256
+    # Per-stage guidance weights multiplying cfg_scale, one per patch_nums entry
+    # (None for the linear ramp si / 9); stages weighted 0 skip the unconditional pass
+    var_cfg_schedule: Optional[tuple] = None
+    
+    # Inference precision of the VAR blocks, the VAE decoder and the CLIP text tower:
+    # 'float32', 'bfloat16' or 'float16' (not on CPU). VAR and VAE store their weights
+    # in that dtype, CLIP runs under autocast; the attention core, logits/softmax and
+    # GroupNorm stay in float32 (tests/test_precision.py bounds the drift;
+    # scripts/report_precision_parity.py measures it on the real checkpoints)
+    var_dtype: str = 'float32'
+    vae_dtype: str = 'float32'
+    clip_dtype: str = 'float32'
+    
+    # CLIP text encoder (only the text tower is loaded)
+    clip_model: str = 'ViT-L-14'
+    clip_pretrained: str = 'laion2b_s32b_b82k'
     
     n_cond_embed: int = 768
     patch_nums: tuple = (1, 2, 3, 4, 5, 6, 8, 10, 13, 16)
     vocab_size: int = 4096
     Cvae: int = 32
     ch: int = 160
+    
+    def inference_dtypes(self, device: Union[str, torch.device]) -> Dict[str, Optional[torch.dtype]]:
+        """Torch dtypes of 'var', 'vae' and 'clip' on device (None for float32)"""
+        dtypes = {}
+        for component in ('var', 'vae', 'clip'):
+            name = getattr(self, f"{component}_dtype")
+            if name not in INFERENCE_DTYPES:
+                raise ValueError(f"Unknown {component}_dtype {name!r}, expected one of {sorted(INFERENCE_DTYPES)}")
+            if name == 'float16' and torch.device(device).type == 'cpu':
+                # Half kernels are missing or slow on CPU in parts of the supported torch range
+                raise ValueError(f"{component}_dtype='float16' is not supported on CPU, use 'bfloat16'")
+            dtypes[component] = INFERENCE_DTYPES[name]
+        return dtypes
 
 
 @dataclass 
@@ -35,12 +72,74 @@ class AppConfig:
     # Device
     device: str = field(default_factory=lambda: "cuda" if torch.cuda.is_available() else "cpu")
     
+    # Maximum number of prompts per generate_batch call
+    max_batch_size: int = 8
+    
+    # Batch sizes to run a warmup generation for at startup
+    warmup_batch_sizes: tuple = (1,)
+    
+    # Micro-batching of concurrent single-prompt requests
+    microbatch_max_size: int = 8
+    microbatch_max_wait_ms: float = 10.0
+    
+    # Quality tiers: the last stage (index into patch_nums) each tier runs before
+    # decoding; fewer stages trade detail for latency
+    quality_tiers: dict = field(default_factory=lambda: {"fast": 7, "balanced": 8, "full": 9})
+    default_tier: str = "full"
+    
+    # Token decoding (/api/decode): token sets per request
+    decode_max_items: int = 64
+    
+    # VAE decoder: channels_last convs (pays off with cuDNN; neutral on CPU), and the
+    # activation memory budget of one decoder pass; larger batches are decoded in
+    # chunks (None decodes any batch at once)
+    vae_channels_last: bool = field(default_factory=torch.cuda.is_available)
+    vae_decode_memory_mb: Optional[int] = 1024
+    
+    # Progressive streaming (/api/generate/stream): stages (indices into patch_nums)
+    # that emit a JPEG preview before the final PNG
+    stream_preview_stages: tuple = (0, 3, 6)
+    
+    # Inference executor: concurrent jobs, waiting requests before rejecting,
+    # and the Retry-After (seconds) sent with rejections
+    inference_workers: int = 1
+    inference_queue_size: int = 16
+    inference_retry_after_s: int = 5
+    
+    # Prompt embedding cache: in-memory LRU entries, and the directory of the
+    # persistent tier under cache_dir (None to keep the cache in memory only)
+    prompt_cache_size: int = 4096
+    prompt_cache_subdir: Optional[str] = "prompt_embeddings"
+    
+    # Result cache for seeded requests: in-memory and on-disk budgets, and the
+    # directory of the disk tier under cache_dir (None to keep it in memory only)
+    result_cache_memory_mb: int = 64
+    result_cache_disk_mb: int = 1024
+    result_cache_subdir: Optional[str] = "results"
+    
+    # Identifies the deployed weights in result cache keys; bump when they change
+    model_version: str = "1"
+    
+    # Converted weights (scripts/convert_checkpoints.py), looked up in cache_dir
+    var_safetensors: str = "var.safetensors"
+    vae_safetensors: str = "vae.safetensors"
+    
     # Paths (will be set after download)
     model_path: Path = None
     vae_path: Path = None
     
     def download_weights(self):
-        """Download weights from HF Hub if not cached"""
+        """Download weights from HF Hub if not cached
+        
+        Converted safetensors files in cache_dir take precedence and skip the download.
+        """
+        var_st = self.cache_dir / self.var_safetensors
+        vae_st = self.cache_dir / self.vae_safetensors
+        if var_st.exists() and vae_st.exists():
+            self.model_path, self.vae_path = var_st, vae_st
+            print(f"✓ Using converted weights: {var_st}, {vae_st}")
+            return
+        
         from huggingface_hub import hf_hub_download
         
         os.makedirs(self.cache_dir, exist_ok=True)
@@ -66,3 +165,4 @@ class AppConfig:
 
 model_config = ModelConfig()
 app_config = AppConfig()
+model_config.inference_dtypes(app_config.device)  # reject an invalid dtype policy at startup
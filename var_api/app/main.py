@@ -1,22 +1,38 @@
 # ===== app/main.py =====
 
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+
 import gradio as gr
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image
+from pydantic import BaseModel, Field
+from typing import List, Optional
 import base64
 import io
+import json
 
-# Import your generator
-from app.services.generator import ImageGenerator
+# Shared generator, the micro-batcher in front of it and the inference executor
+from app.services import generator, batcher, inference_executor, result_cache, QueueFullError
 from app.config import app_config, model_config
 
-# Initialize generator
-generator = ImageGenerator()
-
 # ============ FastAPI App ============
-app = FastAPI(title="VAR Text-to-Image API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load and warm up the models in the background so the server boots immediately"""
+    threading.Thread(
+        target=generator.preload,
+        args=(app_config.warmup_batch_sizes,),
+        name="model-preload",
+        daemon=True
+    ).start()
+    yield
+
+app = FastAPI(title="VAR Text-to-Image API", lifespan=lifespan)
 
 # CORS for Vercel frontend
 app.add_middleware(
@@ -38,36 +54,133 @@ class GenerateRequest(BaseModel):
     top_k: int = 900
     top_p: float = 0.96
     seed: Optional[int] = None
+    # Several images of the prompt: image i uses seeds[i], or seed + i
+    num_images: int = Field(default=1, ge=1, le=app_config.max_batch_size)
+    seeds: Optional[List[int]] = Field(default=None, max_length=app_config.max_batch_size)
+    # Quality tier (app_config.quality_tiers); None for the default
+    tier: Optional[str] = Field(default=None, pattern="^(" + "|".join(app_config.quality_tiers) + ")$")
+    # Also return each image's token indices, to re-sample its detail with /api/generate/vary
+    return_tokens: bool = False
+
+class VaryRequest(BaseModel):
+    prompt: str
+    # Token indices of the image to vary, as returned with return_tokens
+    tokens: str
+    # Number of coarse stages kept from `tokens`; the finer ones are re-sampled
+    keep_stages: int = Field(ge=1, le=len(model_config.patch_nums) - 1)
+    cfg_scale: float = 1.5
+    top_k: int = 900
+    top_p: float = 0.96
+    seed: Optional[int] = None
+    num_images: int = Field(default=1, ge=1, le=app_config.max_batch_size)
+    seeds: Optional[List[int]] = Field(default=None, max_length=app_config.max_batch_size)
+    tier: Optional[str] = Field(default=None, pattern="^(" + "|".join(app_config.quality_tiers) + ")$")
+
+class DecodeRequest(BaseModel):
+    # Packed token indices per image, as returned by /api/generate/tokens
+    tokens: List[str] = Field(min_length=1, max_length=app_config.decode_max_items)
 
 # ============ REST API Endpoints ============
 
+def _not_loaded_response() -> JSONResponse:
+    """503 while the models are still loading"""
+    return JSONResponse(
+        status_code=503,
+        content={"success": False, "error": generator.load_error or "Model is loading"},
+        headers={"Retry-After": str(app_config.inference_retry_after_s)}
+    )
+
+def _images_response(prompt: str, pngs: List[bytes], params: dict) -> dict:
+    """Response for several images, with each image's seed (and tokens, if returned)"""
+    tokens = params.pop("tokens", None)
+    images = [
+        {"seed": seed, "image_base64": base64.b64encode(png).decode()}
+        for seed, png in zip(params["seeds"], pngs)
+    ]
+    if tokens is not None:
+        for image, image_tokens in zip(images, tokens):
+            image["tokens"] = image_tokens
+    return {
+        "success": True,
+        "image_base64": images[0]["image_base64"],
+        "images": images,
+        "prompt": prompt,
+        "parameters": params
+    }
+
 @app.get("/api/health")
 async def health():
+    """Liveness: the server is up, whether or not the models are loaded"""
     return {
         "status": "healthy",
         "model_loaded": generator.is_loaded,
         "device": str(app_config.device)
     }
 
+@app.get("/api/ready")
+async def ready():
+    """Readiness: models loaded and warmed up, with per-stage startup progress"""
+    content = {
+        "ready": generator.is_ready,
+        "stages": dict(generator.load_progress),
+        "error": generator.load_error
+    }
+    if generator.is_ready:
+        return content
+    return JSONResponse(
+        status_code=503,
+        content=content,
+        headers={"Retry-After": str(app_config.inference_retry_after_s)}
+    )
+
 @app.post("/api/generate")
 async def generate(request: GenerateRequest):
     """REST API endpoint for frontend"""
+    if not generator.is_loaded:
+        return _not_loaded_response()
+    
     try:
-        if not generator.is_loaded:
-            generator.load_models()
+        if request.return_tokens:
+            # Tokens are not cached or batched: run the samples directly
+            pil_images, params = await inference_executor.run(
+                generator.generate_samples,
+                prompt=request.prompt,
+                num_images=request.num_images,
+                cfg_scale=request.cfg_scale,
+                top_k=request.top_k,
+                top_p=request.top_p,
+                seed=request.seeds if request.seeds is not None else request.seed,
+                tier=request.tier,
+                return_tokens=True
+            )
+            return _images_response(request.prompt, [generator.pil_to_bytes(img) for img in pil_images], params)
+        
+        if request.num_images > 1 or request.seeds is not None:
+            # Several samples of one prompt, encoded and conditioned once, returned in seed order
+            pngs, params = await batcher.submit_samples_png(
+                prompt=request.prompt,
+                num_images=request.num_images,
+                cfg_scale=request.cfg_scale,
+                top_k=request.top_k,
+                top_p=request.top_p,
+                seed=request.seed,
+                seeds=request.seeds,
+                tier=request.tier
+            )
+            return _images_response(request.prompt, pngs, params)
         
-        pil_image, params = generator.generate(
+        # Concurrent requests are batched into one forward pass; seeded ones may hit the result cache
+        png, params = await batcher.submit_png(
             prompt=request.prompt,
             cfg_scale=request.cfg_scale,
             top_k=request.top_k,
             top_p=request.top_p,
-            seed=request.seed
+            seed=request.seed,
+            tier=request.tier
         )
         
         # Convert to base64
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format="PNG")
-        image_base64 = base64.b64encode(buffer.getvalue()).decode()
+        image_base64 = base64.b64encode(png).decode()
         
         return {
             "success": True,
@@ -75,29 +188,268 @@ async def generate(request: GenerateRequest):
             "prompt": request.prompt,
             "parameters": params
         }
+    except QueueFullError as e:
+        return JSONResponse(
+            status_code=429,
+            content={"success": False, "error": str(e)},
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         return {
             "success": False,
             "error": str(e)
         }
 
+@app.post("/api/generate/tokens")
+async def generate_tokens(request: GenerateRequest):
+    """
+    Generate without decoding: each image is returned as its packed token indices
+    (~1.4 KB instead of a ~100 KB PNG), to be rendered later with /api/decode
+    """
+    if not generator.is_loaded:
+        return _not_loaded_response()
+    
+    try:
+        tokens, params = await inference_executor.run(
+            generator.generate_tokens,
+            prompt=request.prompt,
+            num_images=request.num_images,
+            cfg_scale=request.cfg_scale,
+            top_k=request.top_k,
+            top_p=request.top_p,
+            seed=request.seeds if request.seeds is not None else request.seed,
+            tier=request.tier
+        )
+        return {
+            "success": True,
+            "images": [{"seed": seed, "tokens": t} for seed, t in zip(params["seeds"], tokens)],
+            "prompt": request.prompt,
+            "parameters": params
+        }
+    except QueueFullError as e:
+        return JSONResponse(
+            status_code=429,
+            content={"success": False, "error": str(e)},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+@app.post("/api/decode")
+async def decode(request: DecodeRequest):
+    """Render token sets from /api/generate/tokens into base64 PNGs, batched through the VAE decoder"""
+    if not generator.is_loaded:
+        return _not_loaded_response()
+    
+    try:
+        pil_images = await inference_executor.run(generator.decode_tokens, request.tokens)
+        return {
+            "success": True,
+            "count": len(pil_images),
+            "images": [generator.pil_to_base64(img) for img in pil_images]
+        }
+    except QueueFullError as e:
+        return JSONResponse(
+            status_code=429,
+            content={"success": False, "error": str(e)},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+@app.post("/api/generate/vary")
+async def generate_vary(request: VaryRequest):
+    """
+    Variations of an earlier image: keep its first keep_stages stages and re-sample
+    the finer ones with new seeds, so the composition stays and the detail changes
+    """
+    if not generator.is_loaded:
+        return _not_loaded_response()
+    
+    try:
+        pil_images, params = await inference_executor.run(
+            generator.vary,
+            prompt=request.prompt,
+            tokens=request.tokens,
+            keep_stages=request.keep_stages,
+            num_images=request.num_images,
+            cfg_scale=request.cfg_scale,
+            top_k=request.top_k,
+            top_p=request.top_p,
+            seed=request.seeds if request.seeds is not None else request.seed,
+            tier=request.tier
+        )
+        return _images_response(request.prompt, [generator.pil_to_bytes(img) for img in pil_images], params)
+    except QueueFullError as e:
+        return JSONResponse(
+            status_code=429,
+            content={"success": False, "error": str(e)},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+def _sse(event: str, data: dict) -> str:
+    """One server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _progressive_events(request: GenerateRequest):
+    """Run generate_progressive and encode its images, on the inference executor"""
+    stages = generator.generate_progressive(
+        prompt=request.prompt,
+        cfg_scale=request.cfg_scale,
+        top_k=request.top_k,
+        top_p=request.top_p,
+        seed=request.seed,
+        preview_stages=app_config.stream_preview_stages,
+        tier=request.tier
+    )
+    for stage, image, params in stages:
+        if params is None:
+            yield _sse("preview", {
+                "stage": stage,
+                "resolution": image.width,
+                "image_base64": generator.pil_to_base64(image, format="JPEG")
+            })
+            continue
+        
+        png = generator.pil_to_bytes(image)
+        if request.seed is not None:
+            result_cache.put(generator.request_key(
+                request.prompt, request.cfg_scale, request.top_k, request.top_p, request.seed, request.tier
+            ), png)
+        yield _sse("final", {
+            "success": True,
+            "image_base64": base64.b64encode(png).decode(),
+            "prompt": request.prompt,
+            "parameters": params
+        })
+
+@app.post("/api/generate/stream")
+async def generate_stream(request: GenerateRequest):
+    """
+    Server-sent events: JPEG previews of the coarse stages, then the final PNG
+    
+    Emits `preview` events ({stage, resolution, image_base64}), then one `final`
+    event shaped like the /api/generate response, or an `error` event.
+    """
+    if not generator.is_loaded:
+        return _not_loaded_response()
+    if request.num_images > 1 or request.seeds is not None:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "error": "Streaming generates one image, use /api/generate for several"}
+        )
+    
+    # A cached seeded result needs no previews
+    png = None
+    if request.seed is not None:
+        key = generator.request_key(
+            request.prompt, request.cfg_scale, request.top_k, request.top_p, request.seed, request.tier
+        )
+        png = await asyncio.to_thread(result_cache.get, key)  # may read from disk
+    
+    if png is not None:
+        async def events():
+            yield _sse("final", {
+                "success": True,
+                "image_base64": base64.b64encode(png).decode(),
+                "prompt": request.prompt,
+                "parameters": {
+                    "prompt": request.prompt,
+                    "cfg_scale": request.cfg_scale,
+                    "top_k": request.top_k,
+                    "top_p": request.top_p,
+                    "seed": request.seed,
+                    "tier": generator.resolve_tier(request.tier)[0]
+                }
+            })
+    else:
+        try:
+            stream = inference_executor.stream(_progressive_events, request)
+        except QueueFullError as e:
+            return JSONResponse(
+                status_code=429,
+                content={"success": False, "error": str(e)},
+                headers={"Retry-After": str(e.retry_after)}
+            )
+        
+        async def events():
+            try:
+                async for event in stream:
+                    yield event
+            except Exception as e:
+                yield _sse("error", {"success": False, "error": str(e)})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/stats")
+async def stats():
+    """Serving statistics"""
+    return {
+        "batching": batcher.stats.as_dict(),
+        "inference": inference_executor.stats(),
+        "prompt_cache": generator.prompt_cache.stats() if generator.prompt_cache is not None else None,
+        "result_cache": result_cache.stats(),
+        "single_flight": generator.inflight_stats(),
+        "prefix_cache": generator.var.prefix_cache.stats() if generator.var is not None else None
+    }
+
 # ============ Gradio Interface (Required for HF Spaces GPU) ============
 
-def gradio_generate(prompt, cfg_scale, top_k, top_p, seed):
+def gradio_generate(prompt, cfg_scale, top_k, top_p, seed, tier=None):
     """Gradio interface function"""
     if not generator.is_loaded:
-        generator.load_models()
+        raise gr.Error(generator.load_error or "Model is still loading, please retry shortly")
     
     seed_val = int(seed) if seed and seed.strip() else None
+    cfg_scale, top_k, top_p = float(cfg_scale), int(top_k), float(top_p)
     
-    pil_image, _ = generator.generate(
-        prompt=prompt,
-        cfg_scale=float(cfg_scale),
-        top_k=int(top_k),
-        top_p=float(top_p),
-        seed=seed_val
-    )
-    return pil_image
+    def generate_image() -> Image.Image:
+        pil_image, _ = inference_executor.run_sync(
+            generator.generate,
+            prompt=prompt,
+            cfg_scale=cfg_scale,
+            top_k=top_k,
+            top_p=top_p,
+            seed=seed_val,
+            tier=tier
+        )
+        return pil_image
+    
+    def generate_and_cache() -> bytes:
+        png = generator.pil_to_bytes(generate_image())
+        result_cache.put(key, png)
+        return png
+    
+    try:
+        if seed_val is None:
+            return generate_image()
+        
+        # Seeded requests are deterministic: serve them from the result cache when
+        # possible and share one generation between identical concurrent requests
+        key = generator.request_key(prompt, cfg_scale, top_k, top_p, seed_val, tier)
+        png = result_cache.get(key)
+        if png is None:
+            png = generator.coalesce(key, generate_and_cache)
+    except QueueFullError as e:
+        raise gr.Error(str(e))
+    return Image.open(io.BytesIO(png))
 
 # Create Gradio interface
 demo = gr.Interface(
@@ -108,12 +460,13 @@ demo = gr.Interface(
         gr.Slider(0, 4096, value=900, step=50, label="Top-K"),
         gr.Slider(0.0, 1.0, value=0.96, step=0.01, label="Top-P"),
         gr.Textbox(label="Seed", placeholder="Leave empty for random"),
+        gr.Radio(list(app_config.quality_tiers), value=app_config.default_tier, label="Quality"),
     ],
     outputs=gr.Image(type="pil", label="Generated Image"),
     title="🌸 VAR Flower Generator",
     examples=[
-        ["a beautiful red rose flower", 1.5, 900, 0.96, "42"],
-        ["a yellow sunflower with green leaves", 2.0, 900, 0.96, ""],
+        ["a beautiful red rose flower", 1.5, 900, 0.96, "42", "full"],
+        ["a yellow sunflower with green leaves", 2.0, 900, 0.96, "", "fast"],
     ],
 )
 
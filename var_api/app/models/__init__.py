@@ -10,10 +10,15 @@ from .components import (
     SelfAttention,
     FFN,
     AdaLNSelfAttn,
-    AdaLNBeforeHead
+    AdaLNBeforeHead,
+    KVCache,
+    KVCachePool,
+    PrefixCache,
+    autocast
 )
 from .vae import VQVAE, VectorQuantizer2
 from .var import VAR
+from .sampling import TopKTopPSampler
 
 __all__ = [
     'DropPath',
@@ -22,7 +27,12 @@ __all__ = [
     'FFN',
     'AdaLNSelfAttn',
     'AdaLNBeforeHead',
+    'KVCache',
+    'KVCachePool',
+    'PrefixCache',
     'VQVAE',
     'VectorQuantizer2',
-    'VAR'
+    'VAR',
+    'TopKTopPSampler',
+    'autocast'
 ]
\ No newline at end of file
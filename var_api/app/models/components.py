@@ -5,6 +5,10 @@ Reference code from the original VAR repository - https://github.com/FoundationV
 """
 
 import math
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Tuple
 import numpy as np
 import torch
 import torch.nn as nn
@@ -34,9 +38,23 @@ class DropPath(nn.Module):
         return drop_path(x, self.drop_prob, self.training)
 
 
+def autocast(device_type: str, dtype: Optional[torch.dtype]):
+    """Autocast context running matmuls and convs in `dtype` (a no-op for None or float32)"""
+    if dtype is None or dtype == torch.float32:
+        return nullcontext()
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+
+class GroupNorm32(nn.GroupNorm):
+    """GroupNorm computed in float32 (with float32 parameters), returning the input dtype"""
+    
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return F.group_norm(x.float(), self.num_groups, self.weight, self.bias, self.eps).to(x.dtype)
+
+
 def Normalize(in_channels: int, num_groups: int = 32) -> nn.GroupNorm:
     """Group normalization"""
-    return nn.GroupNorm(num_groups=num_groups, num_channels=in_channels, eps=1e-6, affine=True)
+    return GroupNorm32(num_groups=num_groups, num_channels=in_channels, eps=1e-6, affine=True)
 
 
 class Upsample2x(nn.Module):
@@ -106,11 +124,12 @@ class AttnBlock(nn.Module):
         
         q = q.view(B, C, H * W).permute(0, 2, 1)
         k = k.view(B, C, H * W)
-        w = torch.bmm(q, k).mul_(self.w_ratio)
+        # Scores and softmax in float32 whatever the decoder's dtype
+        w = torch.bmm(q.float(), k.float()).mul_(self.w_ratio)
         w = F.softmax(w, dim=2)
         
         v = v.view(B, C, H * W)
-        w = w.permute(0, 2, 1)
+        w = w.permute(0, 2, 1).to(v.dtype)
         h = torch.bmm(v, w)
         h = h.view(B, C, H, W)
         
@@ -124,6 +143,148 @@ def make_attn(in_channels: int, using_sa: bool = True) -> nn.Module:
 
 # ============ Transformer Components ============
 
+class KVCache:
+    """Preallocated key/value buffers for one attention layer
+    
+    Buffers are sized for the full token sequence up front and each stage
+    writes its keys/values in place at its offset, instead of growing the
+    cache with torch.cat.
+    """
+    
+    def __init__(
+        self, 
+        batch_size: int, 
+        num_heads: int, 
+        max_len: int, 
+        head_dim: int, 
+        device: torch.device = None, 
+        dtype: torch.dtype = torch.float32
+    ):
+        shape = (batch_size, num_heads, max_len, head_dim)
+        self.k = torch.empty(shape, device=device, dtype=dtype)
+        self.v = torch.empty(shape, device=device, dtype=dtype)
+    
+    def update(self, k: torch.Tensor, v: torch.Tensor, start: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write k/v at [start, start + L) and return the filled prefix [0, start + L)"""
+        end = start + k.shape[2]
+        self.k[:, :, start:end] = k
+        self.v[:, :, start:end] = v
+        return self.k[:, :, :end], self.v[:, :, :end]
+    
+    def rows(self, start: int, end: int) -> 'KVCache':
+        """Cache of rows [start, end), sharing these buffers"""
+        view = KVCache.__new__(KVCache)
+        view.k, view.v = self.k[start:end], self.v[start:end]
+        return view
+
+
+class KVCachePool:
+    """Pool of per-layer KV caches shared by all batch sizes
+    
+    Caches are borrowed for the duration of one generation and returned
+    afterwards. A set holds as many rows as the largest batch it has served and
+    smaller batches borrow views of its first rows, so the idle buffers stay at
+    one set per concurrent generation instead of one per batch size. At most
+    `max_idle` idle sets are retained; the smallest are dropped first.
+    """
+    
+    def __init__(self, num_layers: int, num_heads: int, max_len: int, head_dim: int, max_idle: int = 4):
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.max_len = max_len
+        self.head_dim = head_dim
+        self.max_idle = max_idle
+        self._idle: Dict[tuple, List[List[KVCache]]] = {}  # (device, dtype) -> sets, smallest first
+        self._lock = threading.Lock()
+    
+    def _acquire(self, key: tuple, batch_size: int) -> List[KVCache]:
+        with self._lock:
+            sets = self._idle.get(key)
+            caches = sets.pop() if sets else None
+        if caches is not None and caches[0].k.shape[0] >= batch_size:
+            return caches
+        # Too small (or none idle): replace it with a set sized for this batch
+        device, dtype = key
+        return [
+            KVCache(batch_size, self.num_heads, self.max_len, self.head_dim, device, dtype)
+            for _ in range(self.num_layers)
+        ]
+    
+    def _release(self, key: tuple, caches: List[KVCache]):
+        with self._lock:
+            sets = self._idle.setdefault(key, [])
+            sets.append(caches)
+            sets.sort(key=lambda c: c[0].k.shape[0])
+            while sum(len(s) for s in self._idle.values()) > self.max_idle:
+                smallest = min(
+                    (k for k in self._idle if self._idle[k]), key=lambda k: self._idle[k][0][0].k.shape[0]
+                )
+                self._idle[smallest].pop(0)
+    
+    @contextmanager
+    def borrow(self, batch_size: int, device: torch.device, dtype: torch.dtype = torch.float32):
+        """Borrow one KV cache per layer for `batch_size` rows"""
+        key = (torch.device(device), dtype)
+        caches = self._acquire(key, batch_size)
+        try:
+            yield [cache.rows(0, batch_size) for cache in caches]
+        finally:
+            self._release(key, caches)
+    
+    def clear(self):
+        """Drop all idle caches"""
+        with self._lock:
+            self._idle.clear()
+
+
+class PrefixCache:
+    """LRU cache of per-prompt stage-0 state (keys/values of every layer and logits)
+    
+    Stage 0 only sees the condition embedding, so its state is a pure function of
+    the prompt embedding and can be replayed for every new seed. Thread-safe; at
+    most `max_entries` entries are kept, 0 disables the cache.
+    """
+    
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
 class SelfAttention(nn.Module):
     """Self-attention for VAR transformer"""
     
@@ -133,14 +294,17 @@ class SelfAttention(nn.Module):
         num_heads: int = 12, 
         attn_drop: float = 0., 
         proj_drop: float = 0., 
-        attn_l2_norm: bool = True
+        attn_l2_norm: bool = True, 
+        attn_backend: str = 'math'
     ):
         super().__init__()
         assert embed_dim % num_heads == 0
+        assert attn_backend in ('math', 'sdpa'), f"Unknown attention backend: {attn_backend}"
         
         self.num_heads = num_heads
         self.head_dim = embed_dim // num_heads
         self.attn_l2_norm = attn_l2_norm
+        self.attn_backend = attn_backend
         
         if attn_l2_norm:
             self.scale = 1.0
@@ -158,36 +322,72 @@ class SelfAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop) if proj_drop > 0 else nn.Identity()
         self.attn_drop = attn_drop
         
-        # KV caching for inference
-        self.caching = False
-        self.cached_k = None
-        self.cached_v = None
-    
-    def kv_caching(self, enable: bool):
-        """Enable/disable KV caching"""
-        self.caching = enable
-        self.cached_k = None
-        self.cached_v = None
-    
-    def forward(self, x: torch.Tensor, attn_bias: torch.Tensor = None) -> torch.Tensor:
+        # Constants precomputed by freeze()
+        self.frozen = False
+        self.register_buffer('frozen_qkv_bias', None, persistent=False)
+        self.register_buffer('frozen_scale_mul', None, persistent=False)
+    
+    @torch.no_grad()
+    def freeze(self):
+        """Precompute the fused qkv bias and clamped scale multiplier for inference
+        
+        The bias takes the dtype of mat_qkv's weight. Call again after the weights change.
+        """
+        qkv_bias = torch.cat([self.q_bias, self.zero_k_bias, self.v_bias])
+        self.frozen_qkv_bias = qkv_bias.to(self.mat_qkv.weight.dtype)
+        if self.attn_l2_norm:
+            self.frozen_scale_mul = self.scale_mul.clamp_max(self.max_scale_mul).exp()
+        self.frozen = True
+    
+    def forward(
+        self, 
+        x: torch.Tensor, 
+        attn_bias: torch.Tensor = None, 
+        kv_cache: KVCache = None, 
+        cache_pos: int = 0
+    ) -> torch.Tensor:
         B, L, C = x.shape
         
-        qkv = F.linear(x, self.mat_qkv.weight, torch.cat([self.q_bias, self.zero_k_bias, self.v_bias]))
+        if self.frozen:
+            qkv_bias = self.frozen_qkv_bias
+        else:
+            qkv_bias = torch.cat([self.q_bias, self.zero_k_bias, self.v_bias])
+        # The projections run in the weights' dtype (see VAR compute_dtype)
+        qkv = F.linear(x.to(self.mat_qkv.weight.dtype), self.mat_qkv.weight, qkv_bias)
         qkv = qkv.view(B, L, 3, self.num_heads, self.head_dim)
         q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
         
+        # The L2 normalization, the softmax and the KV cache stay in float32
+        out = self._attend(q.float(), k.float(), v.float(), attn_bias, kv_cache, cache_pos)
+        out = out.transpose(1, 2).reshape(B, L, C).to(self.proj.weight.dtype)
+        return self.proj_drop(self.proj(out))
+    
+    def _attend(
+        self, 
+        q: torch.Tensor, 
+        k: torch.Tensor, 
+        v: torch.Tensor, 
+        attn_bias: Optional[torch.Tensor], 
+        kv_cache: Optional[KVCache], 
+        cache_pos: int
+    ) -> torch.Tensor:
         if self.attn_l2_norm:
-            scale_mul = self.scale_mul.clamp_max(self.max_scale_mul).exp()
+            if self.frozen:
+                scale_mul = self.frozen_scale_mul
+            else:
+                scale_mul = self.scale_mul.clamp_max(self.max_scale_mul).exp()
             q = F.normalize(q, dim=-1) * scale_mul
             k = F.normalize(k, dim=-1)
         
-        if self.caching:
-            if self.cached_k is None:
-                self.cached_k, self.cached_v = k, v
-            else:
-                k = torch.cat([self.cached_k, k], dim=2)
-                v = torch.cat([self.cached_v, v], dim=2)
-                self.cached_k, self.cached_v = k, v
+        if kv_cache is not None:
+            k, v = kv_cache.update(k, v, cache_pos)
+        
+        if self.attn_backend == 'sdpa':
+            # Fused kernel; q already carries the learned scale_mul
+            dropout_p = self.attn_drop if self.training else 0.
+            return F.scaled_dot_product_attention(
+                q, k, v, attn_mask=attn_bias, dropout_p=dropout_p, scale=self.scale
+            )
         
         attn = (q * self.scale) @ k.transpose(-2, -1)
         if attn_bias is not None:
@@ -197,8 +397,7 @@ class SelfAttention(nn.Module):
         if self.training and self.attn_drop > 0:
             attn = F.dropout(attn, p=self.attn_drop)
         
-        out = (attn @ v).transpose(1, 2).reshape(B, L, C)
-        return self.proj_drop(self.proj(out))
+        return attn @ v
 
 
 class FFN(nn.Module):
@@ -213,7 +412,7 @@ class FFN(nn.Module):
         self.drop = nn.Dropout(drop) if drop > 0 else nn.Identity()
     
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return self.drop(self.fc2(self.act(self.fc1(x))))
+        return self.drop(self.fc2(self.act(self.fc1(x.to(self.fc1.weight.dtype)))))
 
 
 class AdaLNSelfAttn(nn.Module):
@@ -228,24 +427,37 @@ class AdaLNSelfAttn(nn.Module):
         drop: float = 0., 
         attn_drop: float = 0., 
         drop_path: float = 0., 
-        attn_l2_norm: bool = True
+        attn_l2_norm: bool = True, 
+        attn_backend: str = 'math'
     ):
         super().__init__()
         self.C = embed_dim
         self.D = cond_dim
         
         self.drop_path = DropPath(drop_path) if drop_path > 0 else nn.Identity()
-        self.attn = SelfAttention(embed_dim, num_heads, attn_drop, drop, attn_l2_norm)
+        self.attn = SelfAttention(embed_dim, num_heads, attn_drop, drop, attn_l2_norm, attn_backend)
         self.ffn = FFN(embed_dim, int(embed_dim * mlp_ratio), drop)
         
         self.ln_wo_grad = nn.LayerNorm(embed_dim, elementwise_affine=False, eps=1e-6)
         self.ada_lin = nn.Sequential(nn.SiLU(), nn.Linear(cond_dim, 6 * embed_dim))
     
-    def forward(self, x: torch.Tensor, cond_BD: torch.Tensor, attn_bias: torch.Tensor) -> torch.Tensor:
-        gamma1, gamma2, scale1, scale2, shift1, shift2 = self.ada_lin(cond_BD).view(-1, 1, 6, self.C).unbind(2)
+    def forward(
+        self, 
+        x: torch.Tensor, 
+        cond_BD: torch.Tensor, 
+        attn_bias: torch.Tensor, 
+        kv_cache: KVCache = None, 
+        cache_pos: int = 0, 
+        modulation: Tuple[torch.Tensor, ...] = None
+    ) -> torch.Tensor:
+        if modulation is None:
+            modulation = self.ada_lin(cond_BD).view(-1, 1, 6, self.C).unbind(2)
+        gamma1, gamma2, scale1, scale2, shift1, shift2 = modulation
         
         x = x + self.drop_path(
-            self.attn(self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1), attn_bias).mul_(gamma1)
+            self.attn(
+                self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1), attn_bias, kv_cache, cache_pos
+            ).mul_(gamma1)
         )
         x = x + self.drop_path(
             self.ffn(self.ln_wo_grad(x).mul(scale2.add(1)).add_(shift2)).mul(gamma2)
@@ -262,6 +474,13 @@ class AdaLNBeforeHead(nn.Module):
         self.ln_wo_grad = nn.LayerNorm(C, elementwise_affine=False, eps=1e-6)
         self.ada_lin = nn.Sequential(nn.SiLU(), nn.Linear(D, 2 * C))
     
-    def forward(self, x_BLC: torch.Tensor, cond_BD: torch.Tensor) -> torch.Tensor:
-        scale, shift = self.ada_lin(cond_BD).view(-1, 1, 2, self.C).unbind(2)
+    def forward(
+        self, 
+        x_BLC: torch.Tensor, 
+        cond_BD: torch.Tensor, 
+        modulation: Tuple[torch.Tensor, ...] = None
+    ) -> torch.Tensor:
+        if modulation is None:
+            modulation = self.ada_lin(cond_BD).view(-1, 1, 2, self.C).unbind(2)
+        scale, shift = modulation
         return self.ln_wo_grad(x_BLC).mul(scale.add(1)).add_(shift)
\ No newline at end of file
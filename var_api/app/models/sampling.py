@@ -0,0 +1,68 @@
+# ===== app/models/sampling.py =====
+
+"""Token sampling for VAR generation"""
+
+import torch
+
+
+class TopKTopPSampler:
+    """
+    Row-wise top-k -> top-p sampler
+    
+    Top-p is applied only to the top-k survivors, which come out of topk already
+    sorted, so there is no full-vocabulary sort when top-k is enabled. A single
+    softmax and cumsum give both the nucleus mask and the CDF that the caller's
+    uniforms are inverted against. The sampled distribution is the same as
+    masking the full logits with top-k, then top-p, then sampling the softmax.
+    """
+    
+    def __init__(self, top_k_B: torch.Tensor, top_p_B: torch.Tensor, vocab_size: int):
+        """
+        Args:
+            top_k_B: Per-row top-k [B] (0 to disable)
+            top_p_B: Per-row top-p [B] (0 to disable)
+            vocab_size: Number of logits per token
+        """
+        B = top_k_B.shape[0]
+        top_k_B = top_k_B.clamp(0, vocab_size)
+        
+        # Rows with top-k disabled need the whole (sorted) vocabulary
+        self.k = vocab_size if bool((top_k_B == 0).any()) else int(top_k_B.max())
+        self.mask_top_k = bool(((top_k_B > 0) & (top_k_B < self.k)).any())
+        self.kth_idx_B11 = (top_k_B.masked_fill(top_k_B == 0, self.k) - 1).view(B, 1, 1)
+        
+        self.use_top_p = bool((top_p_B > 0).any())
+        self.top_p_B11 = top_p_B.masked_fill(top_p_B <= 0, float('inf')).view(B, 1, 1)
+    
+    def __call__(self, logits_BlV: torch.Tensor, u_Bl1: torch.Tensor) -> torch.Tensor:
+        """
+        Sample one token per position
+        
+        Args:
+            logits_BlV: Logits [B, l, V]
+            u_Bl1: Uniforms in [0, 1) [B, l, 1]
+        
+        Returns:
+            Token indices [B, l]
+        """
+        B, l, _ = logits_BlV.shape
+        vals, idx = logits_BlV.topk(self.k, dim=-1)
+        
+        # Keep logits >= each row's k-th largest (ties included, as with full-vocab masking)
+        if self.mask_top_k:
+            kth = vals.gather(-1, self.kth_idx_B11.expand(B, l, 1))
+            vals = vals.masked_fill(vals < kth, -float('inf'))
+        
+        probs = vals.softmax(dim=-1)
+        cdf = probs.cumsum(dim=-1)
+        
+        # Nucleus: drop tokens whose preceding mass already exceeds top_p
+        if self.use_top_p:
+            probs = probs.masked_fill(cdf - probs > self.top_p_B11, 0.)
+        
+        # Surviving tokens form a prefix of the sorted order, so the CDF of the
+        # kept tokens is the prefix of `cdf` up to the last non-zero probability
+        last = (probs > 0).sum(dim=-1, keepdim=True) - 1
+        total = cdf.gather(-1, last)
+        j = torch.minimum(torch.searchsorted(cdf, u_Bl1 * total, right=True), last)
+        return idx.gather(-1, j).view(B, l)
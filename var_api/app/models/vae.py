@@ -3,7 +3,7 @@
 """VQVAE model for VAR
 Reference code from the original VAR repository - https://github.com/FoundationVision/VAR.git"""
 
-from typing import Tuple
+from typing import List, Optional, Tuple
 import numpy as np
 import torch
 import torch.nn as nn
@@ -154,6 +154,17 @@ class Decoder(nn.Module):
         return h
 
 
+def resize_matrix(src: int, dst: int, mode: str) -> torch.Tensor:
+    """
+    1D resize from src to dst samples as a [dst, src] matrix M
+    
+    For separable modes ('bicubic', 'area', ...), F.interpolate(x, size=(dst, dst), mode=mode)
+    equals M @ x @ M.T on square maps.
+    """
+    eye = torch.eye(src, dtype=torch.float64).view(src, 1, src, 1)
+    return F.interpolate(eye, size=(dst, 1), mode=mode).view(src, dst).T.contiguous()
+
+
 class Phi(nn.Conv2d):
     """Residual quantization refinement layer"""
     
@@ -181,8 +192,12 @@ class PhiPartiallyShared(nn.Module):
         K = len(qresi_ls)
         self.ticks = np.linspace(1/3/K, 1-1/3/K, K) if K == 4 else np.linspace(1/2/K, 1-1/2/K, K)
     
+    def index_of(self, at_from_0_to_1: float) -> int:
+        """Index of the Phi layer closest to a relative stage position"""
+        return np.argmin(np.abs(self.ticks - at_from_0_to_1)).item()
+    
     def __getitem__(self, at_from_0_to_1: float) -> Phi:
-        return self.qresi_ls[np.argmin(np.abs(self.ticks - at_from_0_to_1)).item()]
+        return self.qresi_ls[self.index_of(at_from_0_to_1)]
 
 
 class VectorQuantizer2(nn.Module):
@@ -196,9 +211,11 @@ class VectorQuantizer2(nn.Module):
         beta: float = 0.25,
         v_patch_nums: Tuple[int, ...] = None, 
         quant_resi: float = 0.5, 
-        share_quant_resi: int = 4
+        share_quant_resi: int = 4,
+        inference_only: bool = False
     ):
         super().__init__()
+        self.inference_only = inference_only
         self.vocab_size = vocab_size
         self.Cvae = Cvae
         self.using_znorm = using_znorm
@@ -209,7 +226,60 @@ class VectorQuantizer2(nn.Module):
         self.quant_resi = PhiPartiallyShared(
             nn.ModuleList([Phi(Cvae, quant_resi) for _ in range(share_quant_resi)])
         )
-        self.register_buffer('ema_vocab_hit_SV', torch.zeros(len(v_patch_nums), vocab_size))
+        # Codebook usage statistics, only updated during training
+        if not inference_only:
+            self.register_buffer('ema_vocab_hit_SV', torch.zeros(len(v_patch_nums), vocab_size))
+        
+        # Phi layer index per stage and per-stage resize matrices, precomputed by freeze_for_inference()
+        self.phi_idx_table = None
+        self.up_mats = None
+        self.down_mats = None
+    
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.inference_only:
+            state_dict.pop(prefix + 'ema_vocab_hit_SV', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+    
+    def freeze_for_inference(self):
+        """
+        Precompute the Phi layer used at each stage of the patch schedule, and the
+        stage resizes as separable matrices (see upsample / downsample)
+        """
+        SN = len(self.v_patch_nums)
+        self.phi_idx_table = [
+            self.quant_resi.index_of(si / (SN - 1)) if SN > 1 else 0 
+            for si in range(SN)
+        ]
+        
+        # The schedule is fixed, so every resize is a fixed linear map: (M, M.T) per stage
+        HW = self.v_patch_nums[-1]
+        weight = self.embedding.weight
+        def pair(m: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+            m = m.to(weight.device, weight.dtype)
+            return m, m.T.contiguous()
+        self.up_mats = [pair(resize_matrix(pn, HW, 'bicubic')) for pn in self.v_patch_nums]
+        self.down_mats = [pair(resize_matrix(HW, pn, 'area')) for pn in self.v_patch_nums]
+    
+    def upsample(self, h_BChw: torch.Tensor, si: int) -> torch.Tensor:
+        """Bicubic resize of a stage-si map [B, C, pn, pn] to the final resolution"""
+        if self.up_mats is None:
+            HW = self.v_patch_nums[-1]
+            return F.interpolate(h_BChw, size=(HW, HW), mode='bicubic')
+        m, m_T = self.up_mats[si]
+        return m.to(h_BChw) @ h_BChw @ m_T.to(h_BChw)
+    
+    def downsample(self, f_hat: torch.Tensor, si: int) -> torch.Tensor:
+        """Area resize of a final-resolution map to the patch size of stage si"""
+        if self.down_mats is None:
+            pn = self.v_patch_nums[si]
+            return F.interpolate(f_hat, size=(pn, pn), mode='area')
+        m, m_T = self.down_mats[si]
+        return m.to(f_hat) @ f_hat @ m_T.to(f_hat)
+    
+    def _phi(self, si: int, SN: int) -> Phi:
+        if self.phi_idx_table is not None and SN == len(self.phi_idx_table):
+            return self.quant_resi.qresi_ls[self.phi_idx_table[si]]
+        return self.quant_resi[si / (SN - 1)]
     
     def get_next_autoregressive_input(
         self, 
@@ -219,24 +289,49 @@ class VectorQuantizer2(nn.Module):
         h_BChw: torch.Tensor
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Get next autoregressive input for generation"""
-        HW = self.v_patch_nums[-1]
-        
         if si != SN - 1:
-            h = self.quant_resi[si / (SN - 1)](F.interpolate(h_BChw, size=(HW, HW), mode='bicubic'))
+            h = self._phi(si, SN)(self.upsample(h_BChw, si))
             f_hat = f_hat + h
-            return f_hat, F.interpolate(
-                f_hat, 
-                size=(self.v_patch_nums[si + 1], self.v_patch_nums[si + 1]), 
-                mode='area'
-            )
+            return f_hat, self.downsample(f_hat, si + 1)
         else:
-            h = self.quant_resi[si / (SN - 1)](h_BChw)
+            h = self._phi(si, SN)(h_BChw)
             f_hat = f_hat + h
             return f_hat, f_hat
+    
+    def idx_to_fhat(self, ms_idx_Bl: List[torch.Tensor]) -> torch.Tensor:
+        """
+        Reconstruct f_hat from the token indices of the first stages
+        
+        Args:
+            ms_idx_Bl: One [B, pn * pn] index tensor per stage, from stage 0 on
+        
+        Returns:
+            f_hat [B, Cvae, H, W], as generation leaves it after those stages
+        """
+        B = ms_idx_Bl[0].shape[0]
+        SN = len(self.v_patch_nums)
+        HW = self.v_patch_nums[-1]
+        f_hat = self.embedding.weight.new_zeros(B, self.Cvae, HW, HW)
+        for si, idx_Bl in enumerate(ms_idx_Bl):
+            pn = self.v_patch_nums[si]
+            h_BChw = self.embedding(idx_Bl).transpose(1, 2).view(B, self.Cvae, pn, pn)
+            if si != SN - 1:
+                h_BChw = self.upsample(h_BChw, si)
+            f_hat = f_hat + self._phi(si, SN)(h_BChw)
+        return f_hat
 
 
 class VQVAE(nn.Module):
-    """Vector Quantized VAE for VAR"""
+    """
+    Vector Quantized VAE for VAR
+    
+    With inference_only=True only the decoding path is built (decoder,
+    post_quant_conv, codebook and quant_resi): the encoder, quant_conv and
+    training statistics are skipped, and their checkpoint entries are ignored.
+    """
+    
+    # Checkpoint entries of the modules skipped by inference_only
+    ENCODER_KEYS = ('encoder.', 'quant_conv.')
     
     def __init__(
         self, 
@@ -249,10 +344,18 @@ class VQVAE(nn.Module):
         quant_resi: float = 0.5, 
         share_quant_resi: int = 4,
         v_patch_nums: Tuple[int, ...] = (1, 2, 3, 4, 5, 6, 8, 10, 13, 16), 
-        test_mode: bool = True
+        test_mode: bool = True,
+        inference_only: bool = False,
+        channels_last: bool = False,
+        decode_memory_mb: Optional[int] = None,
+        compute_dtype: Optional[torch.dtype] = None
     ):
         super().__init__()
         self.test_mode = test_mode
+        self.inference_only = inference_only
+        self.channels_last = channels_last
+        self.decode_memory_mb = decode_memory_mb
+        self.compute_dtype = compute_dtype
         self.V, self.Cvae = vocab_size, z_channels
         self.vocab_size = vocab_size
         
@@ -267,7 +370,7 @@ class VQVAE(nn.Module):
             using_mid_sa=True
         )
         
-        self.encoder = Encoder(double_z=False, **ddconfig)
+        self.encoder = None if inference_only else Encoder(double_z=False, **ddconfig)
         self.decoder = Decoder(**ddconfig)
         
         self.quantize = VectorQuantizer2(
@@ -276,10 +379,13 @@ class VQVAE(nn.Module):
             using_znorm=using_znorm,
             v_patch_nums=v_patch_nums, 
             quant_resi=quant_resi, 
-            share_quant_resi=share_quant_resi
+            share_quant_resi=share_quant_resi,
+            inference_only=inference_only
         )
         
-        self.quant_conv = nn.Conv2d(z_channels, z_channels, quant_conv_ks, stride=1, padding=quant_conv_ks // 2)
+        self.quant_conv = None if inference_only else nn.Conv2d(
+            z_channels, z_channels, quant_conv_ks, stride=1, padding=quant_conv_ks // 2
+        )
         self.post_quant_conv = nn.Conv2d(z_channels, z_channels, quant_conv_ks, stride=1, padding=quant_conv_ks // 2)
         
         if test_mode:
@@ -287,6 +393,64 @@ class VQVAE(nn.Module):
             for p in self.parameters():
                 p.requires_grad_(False)
     
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.inference_only:
+            skipped = tuple(prefix + k for k in self.ENCODER_KEYS)
+            for key in [k for k in state_dict if k.startswith(skipped)]:
+                del state_dict[key]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+    
+    def freeze_for_inference(self):
+        """
+        Precompute the quantizer's stage tables, move the decoder convs to channels_last
+        if enabled, and store the decoder weights in compute_dtype if set (GroupNorm
+        parameters stay float32). Call again after the weights change.
+        """
+        if self.channels_last:
+            self.post_quant_conv.to(memory_format=torch.channels_last)
+            self.decoder.to(memory_format=torch.channels_last)
+        if self.compute_dtype is not None:
+            self.post_quant_conv.to(self.compute_dtype)
+            self.decoder.to(self.compute_dtype)
+            for m in self.decoder.modules():
+                if isinstance(m, nn.GroupNorm):
+                    m.float()
+        self.quantize.freeze_for_inference()
+    
+    def decode_chunk_size(self, f_hat: torch.Tensor) -> int:
+        """
+        Images decoded per decoder pass so peak activation memory stays within
+        decode_memory_mb (the whole batch if unset)
+        
+        Estimated as a few feature maps at the output resolution per image, which is
+        where the decoder's activations peak.
+        """
+        B, _, h, w = f_hat.shape
+        if self.decode_memory_mb is None:
+            return B
+        scale = 2 ** (self.decoder.num_resolutions - 1)
+        conv_out = self.decoder.conv_out  # its input is in the decoder weights' dtype
+        per_image = 6 * conv_out.in_channels * h * scale * w * scale * conv_out.weight.element_size()
+        return max(1, min(B, self.decode_memory_mb * 2 ** 20 // per_image))
+    
     def fhat_to_img(self, f_hat: torch.Tensor) -> torch.Tensor:
-        """Convert f_hat to image"""
-        return self.decoder(self.post_quant_conv(f_hat)).clamp_(-1, 1)
\ No newline at end of file
+        """
+        Convert f_hat to image
+        
+        Runs under inference_mode in the decoder weights' dtype, in chunks of
+        decode_chunk_size() images written into one preallocated (ordinary, contiguous)
+        tensor of f_hat's dtype.
+        """
+        B = f_hat.shape[0]
+        chunk = self.decode_chunk_size(f_hat)
+        img = None
+        for start in range(0, B, chunk):
+            with torch.inference_mode():
+                z = f_hat[start:start + chunk].to(self.post_quant_conv.weight.dtype)
+                if self.channels_last:
+                    z = z.contiguous(memory_format=torch.channels_last)
+                out = self.decoder(self.post_quant_conv(z)).clamp_(-1, 1)
+            if img is None:
+                img = torch.empty((B, *out.shape[1:]), dtype=f_hat.dtype, device=out.device)
+            img[start:start + chunk] = out
+        return img
\ No newline at end of file
@@ -3,13 +3,15 @@
 """VAR (Visual AutoRegressive) model
 Reference code from the original VAR repository - https://github.com/FoundationVision/VAR.git"""
 
+import hashlib
 import math
-from typing import Tuple, Optional
+from typing import Iterator, List, Sequence, Tuple, Optional, Union
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from .components import AdaLNSelfAttn, AdaLNBeforeHead
+from .components import AdaLNSelfAttn, AdaLNBeforeHead, KVCachePool, PrefixCache
+from .sampling import TopKTopPSampler
 from .vae import VQVAE
 
 
@@ -29,10 +31,20 @@ class VAR(nn.Module):
         drop_path_rate: float = 0.1,
         attn_l2_norm: bool = True, 
         cond_drop_rate: float = 0.1, 
-        patch_nums: Tuple[int, ...] = (1, 2, 3, 4, 5, 6, 8, 10, 13, 16)
+        patch_nums: Tuple[int, ...] = (1, 2, 3, 4, 5, 6, 8, 10, 13, 16), 
+        attn_backend: str = 'math',
+        inference_only: bool = False,
+        prefix_cache_size: int = 256,
+        cfg_schedule: Optional[Sequence[float]] = None,
+        compute_dtype: Optional[torch.dtype] = None
     ):
         super().__init__()
         
+        self.inference_only = inference_only
+        # Dtype freeze_for_inference() casts the blocks' projection and FFN weights to
+        # (None for float32); the embeddings, the residual stream, the attention core,
+        # the AdaLN modulation and the head always run in float32
+        self.compute_dtype = compute_dtype
         self.Cvae = vae_local.Cvae
         self.V = vae_local.vocab_size
         self.depth = depth
@@ -46,6 +58,14 @@ class VAR(nn.Module):
         self.first_l = patch_nums[0] ** 2
         self.num_stages_minus_1 = len(patch_nums) - 1
         
+        # Per-stage guidance weight multiplying cfg; defaults to the linear ramp si / (stages - 1)
+        if cfg_schedule is None:
+            n = self.num_stages_minus_1
+            cfg_schedule = [si / n if n > 0 else 0 for si in range(len(patch_nums))]
+        if len(cfg_schedule) != len(patch_nums):
+            raise ValueError(f"cfg_schedule needs {len(patch_nums)} entries, got {len(cfg_schedule)}")
+        self.cfg_schedule = tuple(float(w) for w in cfg_schedule)
+        
         # Store VAE reference (not as parameter)
         self.vae_proxy = (vae_local,)
         self.vae_quant_proxy = (vae_local.quantize,)
@@ -86,61 +106,427 @@ class VAR(nn.Module):
                 drop=drop_rate, 
                 attn_drop=attn_drop_rate,
                 drop_path=dpr[i], 
-                attn_l2_norm=attn_l2_norm
+                attn_l2_norm=attn_l2_norm, 
+                attn_backend=attn_backend
             ) 
             for i in range(depth)
         ])
         
+        # Preallocated KV caches, reused across requests of the same batch size
+        self.kv_cache_pool = KVCachePool(depth, num_heads, self.L, embed_dim // num_heads)
+        
+        # Stage-0 state per prompt embedding (plus one unconditional entry), used once frozen
+        self.prefix_cache = PrefixCache(prefix_cache_size)
+        
         # Attention mask
         d = torch.cat([torch.full((pn*pn,), i) for i, pn in enumerate(patch_nums)]).view(1, self.L, 1)
         dT = d.transpose(1, 2)
         lvl_1L = dT[:, 0].contiguous()
         self.register_buffer('lvl_1L', lvl_1L)
-        attn_bias = torch.where(d >= dT, 0., -torch.inf).reshape(1, 1, self.L, self.L)
-        self.register_buffer('attn_bias_for_masking', attn_bias.contiguous())
+        if not inference_only:
+            # Dense L x L training mask; generate() attends through the KV cache instead
+            attn_bias = torch.where(d >= dT, 0., -torch.inf).reshape(1, 1, self.L, self.L)
+            self.register_buffer('attn_bias_for_masking', attn_bias.contiguous())
         
         # Output head
         self.head_nm = AdaLNBeforeHead(self.C, self.D)
         self.head = nn.Linear(self.C, self.V)
         
+        # Constants precomputed by freeze_for_inference()
+        self.frozen = False
+        self.register_buffer('frozen_lvl_pos', None, persistent=False)
+        self.register_buffer('frozen_ada_weight', None, persistent=False)
+        self.register_buffer('frozen_ada_bias', None, persistent=False)
+        
         self.prog_si = -1
     
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.inference_only:
+            state_dict.pop(prefix + 'attn_bias_for_masking', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+    
+    @torch.no_grad()
+    def freeze_for_inference(self):
+        """
+        Precompute everything that is constant once the weights are loaded
+        
+        Folds the attention biases and scale multipliers, the level + position
+        embeddings, the packed ada_lin weights and the VAE's quantizer tables and
+        decoder memory format, and stores the blocks' projection and FFN weights in
+        compute_dtype if set.
+        Call again after the weights change.
+        """
+        self.eval()
+        self.requires_grad_(False)
+        for block in self.blocks:
+            if self.compute_dtype is not None:
+                block.attn.mat_qkv.to(self.compute_dtype)
+                block.attn.proj.to(self.compute_dtype)
+                block.ffn.to(self.compute_dtype)
+            block.attn.freeze()
+        self.frozen_lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC
+        self.frozen_ada_weight, self.frozen_ada_bias = self._packed_ada_lin()
+        if self.inference_only:
+            self._share_ada_lin()
+        self.vae_proxy[0].freeze_for_inference()
+        self.prefix_cache.clear()
+        self.frozen = True
+    
+    def _packed_ada_lin(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Stack the ada_lin Linear layers of all blocks and the head into one weight/bias"""
+        linears = [block.ada_lin[1] for block in self.blocks] + [self.head_nm.ada_lin[1]]
+        return torch.cat([l.weight for l in linears]), torch.cat([l.bias for l in linears])
+    
+    def _share_ada_lin(self):
+        """
+        Point the per-layer ada_lin parameters at views of the packed buffers
+        
+        Inference-only models never train, so the packed copy replaces the separate
+        per-layer tensors instead of doubling their memory. Training models keep both.
+        """
+        offset = 0
+        for l in [block.ada_lin[1] for block in self.blocks] + [self.head_nm.ada_lin[1]]:
+            rows = slice(offset, offset + l.out_features)
+            l.weight = nn.Parameter(self.frozen_ada_weight[rows], requires_grad=False)
+            l.bias = nn.Parameter(self.frozen_ada_bias[rows], requires_grad=False)
+            offset += l.out_features
+    
+    def _compute_modulation(
+        self, 
+        cond_BD: torch.Tensor
+    ) -> Tuple[List[Tuple[torch.Tensor, ...]], Tuple[torch.Tensor, ...]]:
+        """
+        Compute AdaLN gamma/scale/shift for every block and the head in one matmul
+        
+        Returns:
+            Per-block (gamma1, gamma2, scale1, scale2, shift1, shift2) and head (scale, shift),
+            each [B, 1, C]
+        """
+        if self.frozen:
+            weight, bias = self.frozen_ada_weight, self.frozen_ada_bias
+        else:
+            weight, bias = self._packed_ada_lin()
+        ada = F.linear(F.silu(cond_BD), weight, bias)
+        
+        block_ada, head_ada = ada.split([self.depth * 6 * self.C, 2 * self.C], dim=1)
+        block_ada = block_ada.view(-1, self.depth, 1, 6, self.C)
+        block_mods = [block_ada[:, i].unbind(2) for i in range(self.depth)]
+        head_mod = head_ada.view(-1, 1, 2, self.C).unbind(2)
+        return block_mods, head_mod
+    
+    @staticmethod
+    def _per_row(value, B: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        """Broadcast a scalar or per-row sampling parameter to a [B] tensor"""
+        t = torch.as_tensor(value, dtype=dtype, device=device)
+        return t.expand(B) if t.ndim == 0 else t.view(B)
+    
+    @staticmethod
+    def _make_generators(
+        seed: Union[int, Sequence[Union[int, torch.Generator, None]], torch.Tensor, None], 
+        B: int, 
+        device: torch.device
+    ) -> List[torch.Generator]:
+        """
+        Build one private RNG per row, never touching the global RNG state
+        
+        A scalar seed gives row i the seed `seed + i`, so row 0 of a batch matches a
+        single-image request with the same seed. Per-row entries may be ints,
+        torch.Generator instances (used as given) or None (seeded from OS entropy).
+        """
+        if seed is None:
+            seeds = [None] * B
+        elif isinstance(seed, int):
+            seeds = [seed + i for i in range(B)]
+        else:
+            seeds = seed.tolist() if isinstance(seed, torch.Tensor) else list(seed)
+            if len(seeds) != B:
+                raise ValueError(f"Expected {B} seeds, got {len(seeds)}")
+        
+        generators = []
+        for s in seeds:
+            if isinstance(s, torch.Generator):
+                generators.append(s)
+                continue
+            g = torch.Generator(device=device)
+            if s is None:
+                g.seed()
+            else:
+                g.manual_seed(int(s))
+            generators.append(g)
+        return generators
+    
+    @staticmethod
+    def _draw_uniform(generators: List[torch.Generator], l: int, device: torch.device) -> torch.Tensor:
+        """Draw [B, l, 1] uniforms in [0, 1), each row from its own RNG"""
+        return torch.stack([torch.rand(l, 1, generator=g, device=device) for g in generators])
+    
+    def _last_stage(self, max_stage: Optional[int]) -> int:
+        """Index of the last stage to run"""
+        if max_stage is None:
+            return self.num_stages_minus_1
+        if not 0 <= max_stage <= self.num_stages_minus_1:
+            raise ValueError(f"max_stage must be in [0, {self.num_stages_minus_1}], got {max_stage}")
+        return max_stage
+    
+    def _prefix_keys(self, embed: torch.Tensor, dtype: torch.dtype) -> Tuple[List[tuple], tuple]:
+        """Prefix cache keys: one per row, hashed from its embedding, and the unconditional one"""
+        rows = embed.detach().float().cpu().numpy()
+        precision = (str(dtype), str(self.compute_dtype))
+        keys = [(*precision, hashlib.sha1(row.tobytes()).hexdigest()) for row in rows]
+        return keys, (*precision, 'uncond')
+    
+    def _restore_prefix(self, entries: List[tuple], kv_caches: list) -> torch.Tensor:
+        """
+        Write cached stage-0 keys/values of the conditional rows into the KV caches
+        
+        Returns:
+            Stage-0 logits of the conditional rows [B, first_l, V]
+        """
+        B = len(entries)
+        k_B, v_B = torch.stack([e[0] for e in entries]), torch.stack([e[1] for e in entries])
+        for i, kv_cache in enumerate(kv_caches):
+            kv_cache.k[:B, :, :self.first_l] = k_B[:, i]
+            kv_cache.v[:B, :, :self.first_l] = v_B[:, i]
+        return torch.stack([e[2] for e in entries])
+    
+    def _restore_uncond_prefix(self, uncond: tuple, kv_caches: list):
+        """Write the cached unconditional stage-0 keys/values into every unconditional row"""
+        for i, kv_cache in enumerate(kv_caches):
+            kv_cache.k[:, :, :self.first_l] = uncond[0][i]
+            kv_cache.v[:, :, :self.first_l] = uncond[1][i]
+    
+    def _prefix_state(self, kv_caches: list, row: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Stage-0 keys/values of one row, stacked over layers"""
+        k = torch.stack([kv_cache.k[row, :, :self.first_l] for kv_cache in kv_caches])
+        v = torch.stack([kv_cache.v[row, :, :self.first_l] for kv_cache in kv_caches])
+        return k, v
+    
+    def _store_prefix(self, keys: List[tuple], kv_caches: list, logits_BlV: torch.Tensor):
+        """Cache the stage-0 keys/values and logits of every conditional row"""
+        for b, key in enumerate(keys):
+            self.prefix_cache.put(key, (*self._prefix_state(kv_caches, b), logits_BlV[b].clone()))
+    
+    def _block_causal_bias(self, start: int, end: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        """
+        Attention bias of queries [start, end) over keys [0, end): a token sees every
+        token of its own and earlier stages, as in training
+        
+        Returns:
+            Additive bias [1, 1, end - start, end] of 0 / -inf
+        """
+        lvl = self.lvl_1L[0]
+        visible = lvl[start:end].view(-1, 1) >= lvl[:end].view(1, -1)
+        bias = torch.zeros(visible.shape, dtype=dtype, device=device).masked_fill_(~visible.to(device), -torch.inf)
+        return bias.view(1, 1, end - start, end)
+    
+    def _run_blocks(
+        self, 
+        x: torch.Tensor, 
+        cond_BD: torch.Tensor, 
+        block_mods: List[Tuple[torch.Tensor, ...]], 
+        kv_caches: list, 
+        cache_pos: int, 
+        attn_bias: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Run the transformer blocks over x, writing its keys/values at cache_pos"""
+        for block, kv_cache, mod in zip(self.blocks, kv_caches, block_mods):
+            x = block(x, cond_BD, attn_bias=attn_bias, kv_cache=kv_cache, cache_pos=cache_pos, modulation=mod)
+        return x
+    
+    def _add_stage(self, si: int, f_hat: torch.Tensor, idx_Bl: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Add the tokens of stage si to f_hat, returning (f_hat, next stage's input map)"""
+        B, pn = idx_Bl.shape[0], self.patch_nums[si]
+        h_BChw = self.vae_quant_proxy[0].embedding(idx_Bl).transpose(1, 2).view(B, self.Cvae, pn, pn)
+        return self.vae_quant_proxy[0].get_next_autoregressive_input(si, len(self.patch_nums), f_hat, h_BChw)
+    
+    def _stage_input(self, si: int, next_map: torch.Tensor, lvl_pos: torch.Tensor, start: int) -> torch.Tensor:
+        """Token map of stage si, which starts at position `start`, for the conditional and unconditional rows"""
+        B = next_map.shape[0]
+        next_map = next_map.view(B, self.Cvae, -1).transpose(1, 2)
+        next_map = self.word_embed(next_map) + lvl_pos[:, start:start + self.patch_nums[si] ** 2]
+        return next_map.repeat(2, 1, 1)
+    
+    def _forward(
+        self, 
+        x: torch.Tensor, 
+        cond_BD: torch.Tensor, 
+        block_mods: List[Tuple[torch.Tensor, ...]], 
+        head_mod: Tuple[torch.Tensor, ...], 
+        kv_caches: list, 
+        cache_pos: int, 
+        attn_bias: Optional[torch.Tensor] = None, 
+        out_len: Optional[int] = None
+    ) -> torch.Tensor:
+        """Run the blocks and the head over x, returning float logits of its last `out_len` tokens"""
+        x = self._run_blocks(x, cond_BD, block_mods, kv_caches, cache_pos, attn_bias)
+        if out_len is not None:
+            x = x[:, -out_len:]
+        return self.head(self.head_nm(x.float(), cond_BD, modulation=head_mod).float())
+    
     @torch.no_grad()
     def generate(
         self, 
         embed: torch.Tensor, 
-        cfg: float = 1.5, 
-        top_k: int = 0, 
-        top_p: float = 0.0, 
-        seed: Optional[int] = None
-    ) -> torch.Tensor:
+        cfg: Union[float, torch.Tensor] = 1.5, 
+        top_k: Union[int, torch.Tensor] = 0, 
+        top_p: Union[float, torch.Tensor] = 0.0, 
+        seed: Union[int, Sequence[Union[int, torch.Generator, None]], torch.Tensor, None] = None,
+        num_samples: int = 1,
+        max_stage: Optional[int] = None,
+        prefix_tokens: Optional[Sequence[torch.Tensor]] = None,
+        return_tokens: bool = False
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, List[torch.Tensor]]]:
         """
         Generate images from text embeddings
         
+        Sampling parameters are either scalars shared by the batch or per-row
+        sequences/tensors of length B, so requests with different settings can
+        share one forward pass.
+        
+        With num_samples > 1, each embedding is sampled num_samples times
+        (B = len(embed) * num_samples rows, grouped by embedding); the conditioning
+        and AdaLN modulation are computed once per embedding and broadcast.
+        
+        The guidance at stage si is cfg * cfg_schedule[si]. Where it is zero for every
+        row (stage 0 with the default linear ramp), only the conditional rows run; the
+        unconditional rows catch up on the skipped stages in one block-causal pass at
+        the first guided stage, and are never run if no stage is guided.
+        
+        With max_stage, autoregression stops after that scale and the partial
+        f_hat (already upsampled to full resolution by each stage) is decoded: a
+        coarser image for a fraction of the transformer cost. Earlier stages are
+        unchanged, so it is the coarse version of the full image for the same seed.
+        
+        With prefix_tokens (e.g. returned by an earlier call with return_tokens), the
+        first len(prefix_tokens) stages are not sampled: their tokens are replayed through
+        the KV cache in one block-causal pass and only the finer stages are sampled. The
+        uniforms of the replayed stages are still drawn, so replaying an image's own
+        tokens with its own seed reproduces it, and other seeds vary only its detail.
+        
         Args:
-            embed: Text embeddings [B, n_cond_embed]
-            cfg: Classifier-free guidance scale
-            top_k: Top-k sampling (0 to disable)
-            top_p: Top-p (nucleus) sampling (0 to disable)
-            seed: Random seed for reproducibility
-            
+            embed: Text embeddings [B / num_samples, n_cond_embed]
+            cfg: Classifier-free guidance scale, scalar or [B]
+            top_k: Top-k sampling (0 to disable), scalar or [B]
+            top_p: Top-p (nucleus) sampling (0 to disable), scalar or [B]
+            seed: Random seed for reproducibility, scalar or [B]. Per-row entries may also
+                be torch.Generator instances; None entries are seeded from OS entropy.
+                A row's samples depend only on its own seed, not on the rest of the batch.
+            num_samples: Images per embedding
+            max_stage: Last stage to run, as an index into patch_nums (None for all)
+            prefix_tokens: Token indices of the first stages to keep, one [B or 1, pn * pn]
+                tensor per stage
+            return_tokens: Also return the token indices of every stage
+        
+        Returns:
+            Generated images [B, 3, H, W] in range [0, 1], and with return_tokens the
+            token indices of stages 0..max_stage, one [B, pn * pn] tensor per stage
+        """
+        tokens = []
+        stages = self.iter_stages(embed, cfg, top_k, top_p, seed, num_samples, max_stage, prefix_tokens)
+        for _, f_hat, idx_Bl in stages:
+            tokens.append(idx_Bl)
+        
+        # Decode to image
+        images = self.vae_proxy[0].fhat_to_img(f_hat).add_(1).mul_(0.5)
+        return (images, tokens) if return_tokens else images
+    
+    @torch.no_grad()
+    def generate_tokens(
+        self, 
+        embed: torch.Tensor, 
+        cfg: Union[float, torch.Tensor] = 1.5, 
+        top_k: Union[int, torch.Tensor] = 0, 
+        top_p: Union[float, torch.Tensor] = 0.0, 
+        seed: Union[int, Sequence[Union[int, torch.Generator, None]], torch.Tensor, None] = None,
+        num_samples: int = 1,
+        max_stage: Optional[int] = None
+    ) -> List[torch.Tensor]:
+        """
+        Sample like generate(), but return the token indices instead of decoding them
+        
+        VQVAE.quantize.idx_to_fhat() and fhat_to_img() turn them into the same images later.
+        
         Returns:
-            Generated images [B, 3, H, W] in range [0, 1]
+            Token indices of stages 0..max_stage, one [B, pn * pn] tensor per stage
         """
-        B = embed.shape[0]
+        return [idx_Bl for _, _, idx_Bl in self.iter_stages(embed, cfg, top_k, top_p, seed, num_samples, max_stage)]
+    
+    @torch.no_grad()
+    def generate_progressive(
+        self, 
+        embed: torch.Tensor, 
+        cfg: Union[float, torch.Tensor] = 1.5, 
+        top_k: Union[int, torch.Tensor] = 0, 
+        top_p: Union[float, torch.Tensor] = 0.0, 
+        seed: Union[int, Sequence[Union[int, torch.Generator, None]], torch.Tensor, None] = None,
+        num_samples: int = 1,
+        preview_stages: Sequence[int] = (),
+        max_stage: Optional[int] = None
+    ) -> Iterator[Tuple[int, torch.Tensor]]:
+        """
+        Generate like generate(), yielding previews after the chosen stages
+        
+        A preview decodes the partially refined f_hat area-downsampled to the stage's
+        patch resolution, so early previews are small and cheap. The samples are the
+        same as generate() with the same arguments.
+        
+        Yields:
+            (stage index, images [B, 3, h, w] in range [0, 1]) for every stage in
+            preview_stages, then (last stage index, full-resolution images)
+        """
+        preview_stages = set(preview_stages)
+        last = self._last_stage(max_stage)
+        for si, f_hat, _ in self.iter_stages(embed, cfg, top_k, top_p, seed, num_samples, last):
+            if si == last:
+                yield si, self.vae_proxy[0].fhat_to_img(f_hat).add_(1).mul_(0.5)
+            elif si in preview_stages:
+                f_small = self.vae_quant_proxy[0].downsample(f_hat, si)
+                yield si, self.vae_proxy[0].fhat_to_img(f_small).add_(1).mul_(0.5)
+    
+    @torch.no_grad()
+    def iter_stages(
+        self, 
+        embed: torch.Tensor, 
+        cfg: Union[float, torch.Tensor] = 1.5, 
+        top_k: Union[int, torch.Tensor] = 0, 
+        top_p: Union[float, torch.Tensor] = 0.0, 
+        seed: Union[int, Sequence[Union[int, torch.Generator, None]], torch.Tensor, None] = None,
+        num_samples: int = 1,
+        max_stage: Optional[int] = None,
+        prefix_tokens: Optional[Sequence[torch.Tensor]] = None
+    ) -> Iterator[Tuple[int, torch.Tensor, torch.Tensor]]:
+        """
+        Run the autoregressive loop of generate(), yielding (stage index, f_hat [B, Cvae, H, W],
+        tokens [B, pn * pn]) after every stage up to max_stage; the last f_hat is the one
+        generate() decodes
+        """
+        last = self._last_stage(max_stage)
+        n_replay = len(prefix_tokens) if prefix_tokens is not None else 0
+        if n_replay > last + 1:
+            raise ValueError(f"Got tokens of {n_replay} stages, but only {last + 1} are generated")
+        B = embed.shape[0] * num_samples
         device = embed.device
         self.eval()
         
-        if seed is not None:
-            torch.manual_seed(seed)
-            if device.type == 'cuda':
-                torch.cuda.manual_seed(seed)
+        cfg_B11 = self._per_row(cfg, B, torch.float32, device).view(B, 1, 1)
+        sampler = TopKTopPSampler(
+            self._per_row(top_k, B, torch.long, device), 
+            self._per_row(top_p, B, torch.float32, device), 
+            self.V
+        )
+        generators = self._make_generators(seed, B, device)
         
-        # Prepare conditional and unconditional embeddings
-        noise = self.noise(torch.tensor(0, device=device)).expand(B, -1)
+        # Prepare conditional and unconditional embeddings, once per distinct embedding
+        noise = self.noise.weight[:1].expand(embed.shape[0], -1)
         cond_BD = self.cond_proj(torch.cat([embed, noise], dim=0))
+        block_mods, head_mod = self._compute_modulation(cond_BD)
+        if num_samples > 1:
+            rows = torch.arange(2 * embed.shape[0], device=device).repeat_interleave(num_samples)
+            cond_BD = cond_BD.index_select(0, rows)
+            block_mods = [tuple(m.index_select(0, rows) for m in mod) for mod in block_mods]
+            head_mod = tuple(m.index_select(0, rows) for m in head_mod)
         
-        lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC
+        lvl_pos = self.frozen_lvl_pos if self.frozen else self.lvl_embed(self.lvl_1L) + self.pos_1LC
         next_token_map = (
             cond_BD.unsqueeze(1).expand(2*B, self.first_l, -1) + 
             self.pos_start + lvl_pos[:, :self.first_l]
@@ -149,56 +535,124 @@ class VAR(nn.Module):
         cur_L = 0
         f_hat = embed.new_zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1])
         
-        # Enable KV caching
-        for block in self.blocks:
-            block.attn.kv_caching(True)
+        # Stage guidance is zero where the schedule is, or everywhere if every cfg is
+        any_cfg = bool((cfg_B11 != 0).any())
+        guided = [any_cfg and w != 0 for w in self.cfg_schedule]
         
-        # Autoregressive generation
-        for si, pn in enumerate(self.patch_nums):
-            ratio = si / self.num_stages_minus_1 if self.num_stages_minus_1 > 0 else 0
-            cur_L += pn * pn
-            x = next_token_map
-            
-            for block in self.blocks:
-                x = block(x, cond_BD, attn_bias=None)
-            
-            logits_BlV = self.head(self.head_nm(x.float(), cond_BD).float())
-            
-            # CFG
-            t = cfg * ratio
-            logits_BlV = (1 + t) * logits_BlV[:B] - t * logits_BlV[B:]
-            
-            # Top-k sampling
-            if top_k > 0:
-                v, _ = logits_BlV.topk(top_k, dim=-1)
-                logits_BlV[logits_BlV < v[..., -1:]] = -float('inf')
-            
-            # Top-p sampling
-            if top_p > 0:
-                sorted_logits, sorted_idx = logits_BlV.sort(dim=-1, descending=True)
-                cumsum = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
-                mask = cumsum - sorted_logits.softmax(dim=-1) > top_p
-                sorted_logits[mask] = -float('inf')
-                logits_BlV = sorted_logits.scatter(-1, sorted_idx, sorted_logits)
-            
-            # Sample
-            idx_Bl = logits_BlV.softmax(dim=-1).view(-1, self.V).multinomial(1).view(B, pn*pn)
-            
-            # Get embeddings and update f_hat
-            h_BChw = self.vae_quant_proxy[0].embedding(idx_Bl).transpose(1, 2).view(B, self.Cvae, pn, pn)
-            f_hat, next_token_map = self.vae_quant_proxy[0].get_next_autoregressive_input(
-                si, len(self.patch_nums), f_hat, h_BChw
-            )
-            
-            # Prepare next token map
-            if si != self.num_stages_minus_1:
-                next_token_map = next_token_map.view(B, self.Cvae, -1).transpose(1, 2)
-                next_token_map = self.word_embed(next_token_map) + lvl_pos[:, cur_L:cur_L + self.patch_nums[si+1]**2]
-                next_token_map = next_token_map.repeat(2, 1, 1)
+        # Stage 0 depends only on the embeddings: replay the conditional rows from the prefix cache
+        # if every row is there, and the unconditional rows whenever their shared entry is
+        # (only when stage 0 is unguided, since just the conditional logits are cached)
+        use_prefix_cache = self.frozen and self.prefix_cache.max_entries > 0 and not guided[0] and not n_replay
+        prefix = uncond_prefix = None
+        if use_prefix_cache:
+            prefix_keys, uncond_key = self._prefix_keys(embed, next_token_map.dtype)
+            prefix_keys = [key for key in prefix_keys for _ in range(num_samples)]
+            prefix = [self.prefix_cache.get(key) for key in prefix_keys]
+            if any(entry is None for entry in prefix):
+                prefix = None
+            uncond_prefix = self.prefix_cache.get(uncond_key)
         
-        # Disable KV caching
-        for block in self.blocks:
-            block.attn.kv_caching(False)
+        # Conditional / unconditional halves of the rows, for stages that run them separately
+        cond_mods = ([tuple(m[:B] for m in mod) for mod in block_mods], tuple(m[:B] for m in head_mod))
+        uncond_mods = ([tuple(m[B:] for m in mod) for mod in block_mods], tuple(m[B:] for m in head_mod))
         
-        # Decode to image
-        return self.vae_proxy[0].fhat_to_img(f_hat).add_(1).mul_(0.5)
\ No newline at end of file
+        # Unconditional token maps of the skipped stages, from position uncond_start on
+        uncond_start = None
+        uncond_pending = []
+        
+        # Autoregressive generation, writing keys/values into preallocated caches
+        with self.kv_cache_pool.borrow(2 * B, device, next_token_map.dtype) as kv_caches:
+            cond_kv = [kv_cache.rows(0, B) for kv_cache in kv_caches]
+            uncond_kv = [kv_cache.rows(B, 2 * B) for kv_cache in kv_caches]
+            
+            if n_replay:
+                # Rebuild f_hat from the kept tokens, then write the keys/values of those stages
+                # in one block-causal pass (for the unconditional rows only if a later stage is guided)
+                inputs = [next_token_map]
+                for si in range(n_replay):
+                    pn = self.patch_nums[si]
+                    idx_Bl = prefix_tokens[si].to(device).view(-1, pn * pn).expand(B, -1)
+                    self._draw_uniform(generators, pn * pn, device)  # keep each row's RNG stream aligned
+                    f_hat, next_token_map = self._add_stage(si, f_hat, idx_Bl)
+                    cur_L += pn * pn
+                    
+                    yield si, f_hat, idx_Bl
+                    if si == last:
+                        return
+                    next_token_map = self._stage_input(si + 1, next_token_map, lvl_pos, cur_L)
+                    if si + 1 < n_replay:
+                        inputs.append(next_token_map)
+                
+                rows = 2 * B if any(guided[n_replay:last + 1]) else B
+                attn_bias = self._block_causal_bias(0, cur_L, next_token_map.dtype, device)
+                self._run_blocks(
+                    torch.cat(inputs, dim=1)[:rows], cond_BD[:rows], 
+                    [tuple(m[:rows] for m in mod) for mod in block_mods], 
+                    [kv_cache.rows(0, rows) for kv_cache in kv_caches], 0, attn_bias
+                )
+            
+            for si in range(n_replay, last + 1):
+                pn = self.patch_nums[si]
+                stage_start = cur_L
+                cur_L += pn * pn
+                
+                if not guided[si]:
+                    # Zero guidance: the logits are the conditional ones, skip the unconditional rows
+                    if si == 0 and prefix is not None:
+                        logits_BlV = self._restore_prefix(prefix, cond_kv)
+                    else:
+                        logits_BlV = self._forward(
+                            next_token_map[:B], cond_BD[:B], *cond_mods, cond_kv, stage_start
+                        )
+                        if si == 0 and use_prefix_cache:
+                            self._store_prefix(prefix_keys, kv_caches, logits_BlV)
+                    
+                    # The unconditional stage-0 entry is shared by every request, hit or miss
+                    if si == 0 and uncond_prefix is not None:
+                        self._restore_uncond_prefix(uncond_prefix, uncond_kv)
+                    else:
+                        if uncond_start is None:
+                            uncond_start = stage_start
+                        uncond_pending.append(next_token_map[B:])
+                
+                elif uncond_start is None:
+                    logits_BlV = self._forward(next_token_map, cond_BD, block_mods, head_mod, kv_caches, stage_start)
+                    
+                    # CFG, mixed row-wise
+                    t = cfg_B11 * self.cfg_schedule[si]
+                    logits_BlV = (1 + t) * logits_BlV[:B] - t * logits_BlV[B:]
+                
+                else:
+                    # First guided stage after skipped ones: the unconditional rows run the
+                    # skipped stages and this one together, block-causally masked
+                    cond_logits = self._forward(
+                        next_token_map[:B], cond_BD[:B], *cond_mods, cond_kv, stage_start
+                    )
+                    uncond_x = torch.cat(uncond_pending + [next_token_map[B:]], dim=1)
+                    attn_bias = self._block_causal_bias(uncond_start, cur_L, uncond_x.dtype, device)
+                    uncond_logits = self._forward(
+                        uncond_x, cond_BD[B:], *uncond_mods, uncond_kv, uncond_start, 
+                        attn_bias=attn_bias, out_len=pn * pn
+                    )
+                    if uncond_start == 0 and use_prefix_cache and uncond_prefix is None:
+                        self.prefix_cache.put(uncond_key, self._prefix_state(kv_caches, B))
+                    uncond_start = None
+                    uncond_pending = []
+                    
+                    # CFG, mixed row-wise
+                    t = cfg_B11 * self.cfg_schedule[si]
+                    logits_BlV = (1 + t) * cond_logits - t * uncond_logits
+                
+                # Top-k -> top-p sampling with per-row uniforms (drawn on a prefix hit too,
+                # so each row's RNG stream stays aligned)
+                idx_Bl = sampler(logits_BlV, self._draw_uniform(generators, pn*pn, device))
+                
+                # Get embeddings and update f_hat
+                f_hat, next_token_map = self._add_stage(si, f_hat, idx_Bl)
+                
+                yield si, f_hat, idx_Bl
+                if si == last:
+                    break
+                
+                # Prepare next token map
+                next_token_map = self._stage_input(si + 1, next_token_map, lvl_pos, cur_L)
\ No newline at end of file
@@ -1,5 +1,20 @@
 # ===== app/services/__init__.py =====
 
+from .embedding_cache import PromptEmbeddingCache
 from .generator import ImageGenerator, generator
+from .executor import InferenceExecutor, QueueFullError, inference_executor
+from .result_cache import ResultCache, result_cache
+from .batcher import MicroBatcher, batcher
 
-__all__ = ['ImageGenerator', 'generator']
\ No newline at end of file
+__all__ = [
+    'PromptEmbeddingCache',
+    'ImageGenerator',
+    'generator',
+    'InferenceExecutor',
+    'QueueFullError',
+    'inference_executor',
+    'ResultCache',
+    'result_cache',
+    'MicroBatcher',
+    'batcher'
+]
\ No newline at end of file
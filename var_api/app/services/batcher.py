@@ -0,0 +1,342 @@
+# ===== app/services/batcher.py =====
+
+"""Dynamic micro-batching of concurrent single-prompt generation requests"""
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from app.config import app_config
+from .executor import InferenceExecutor, QueueFullError, inference_executor
+from .generator import ImageGenerator, generator
+from .result_cache import ResultCache, result_cache
+
+
+@dataclass
+class _PendingRequest:
+    """A queued single-prompt request waiting to be batched"""
+    prompt: str
+    cfg_scale: float
+    top_k: int
+    top_p: float
+    seed: int
+    tier: str
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+@dataclass
+class BatchStats:
+    """Queue-wait and batch-size statistics"""
+    requests: int = 0
+    batches: int = 0
+    total_wait_ms: float = 0.0
+    max_wait_ms: float = 0.0
+    rejected: int = 0
+    batch_sizes: Dict[int, int] = field(default_factory=dict)
+    
+    def record(self, batch_size: int, waits_ms: List[float]):
+        self.requests += batch_size
+        self.batches += 1
+        self.total_wait_ms += sum(waits_ms)
+        self.max_wait_ms = max(self.max_wait_ms, max(waits_ms))
+        self.batch_sizes[batch_size] = self.batch_sizes.get(batch_size, 0) + 1
+    
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "mean_queue_wait_ms": self.total_wait_ms / self.requests if self.requests else 0.0,
+            "max_queue_wait_ms": self.max_wait_ms,
+            "rejected": self.rejected,
+            "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+        }
+
+
+class MicroBatcher:
+    """
+    Collects concurrent single-prompt requests into one VAR.generate call
+    
+    The first queued request opens a window of `max_wait_ms`; everything that
+    arrives before it closes (up to `max_batch_size` requests) runs as one batch
+    with per-row sampling parameters, and each caller gets its own image back.
+    
+    Batches run on the inference executor, at most one per executor worker; while
+    all workers are busy, new requests keep queuing and join the next batch. At most
+    `max_queue` requests may wait, beyond that submit() raises QueueFullError.
+    
+    submit_png() serves seeded requests from the result cache when possible, without
+    queuing them at all, and queues identical seeded requests only once.
+    """
+    
+    def __init__(
+        self,
+        image_generator: ImageGenerator,
+        executor: InferenceExecutor,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        max_queue: int = 16,
+        cache: Optional[ResultCache] = None
+    ):
+        self.generator = image_generator
+        self.executor = executor
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue = max_queue
+        self.stats = BatchStats()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._batches = set()
+    
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.done():
+            # The worker only stops on an unexpected error. Keep its queue, so the
+            # requests still waiting in it are picked up by the replacement
+            error = "cancelled" if self._worker.cancelled() else repr(self._worker.exception())
+            print(f"✗ Micro-batch worker stopped ({error}), restarting")
+            self._worker = None
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+    
+    async def submit(
+        self,
+        prompt: str,
+        cfg_scale: float = 1.5,
+        top_k: int = 900,
+        top_p: float = 0.96,
+        seed: Optional[int] = None,
+        tier: Optional[str] = None
+    ) -> Tuple[Image.Image, dict]:
+        """Queue one request and wait for its (PIL Image, generation parameters)"""
+        tier, _ = self.generator.resolve_tier(tier)
+        self._ensure_worker()
+        if self._queue.qsize() >= self.max_queue:
+            self.stats.rejected += 1
+            raise QueueFullError(self.executor.retry_after_s)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingRequest(
+            prompt=prompt,
+            cfg_scale=cfg_scale,
+            top_k=top_k,
+            top_p=top_p,
+            seed=self.generator.resolve_seeds(seed, 1),
+            tier=tier,
+            future=future
+        ))
+        return await future
+    
+    async def submit_png(
+        self,
+        prompt: str,
+        cfg_scale: float = 1.5,
+        top_k: int = 900,
+        top_p: float = 0.96,
+        seed: Optional[int] = None,
+        tier: Optional[str] = None
+    ) -> Tuple[bytes, dict]:
+        """
+        Like submit(), but return PNG bytes
+        
+        Requests that supply a seed are deterministic: they are served from the result
+        cache when possible, and identical ones in flight at the same time share one
+        generation.
+        """
+        if seed is None:
+            pil_image, params = await self.submit(prompt, cfg_scale, top_k, top_p, seed, tier)
+            return self.generator.pil_to_bytes(pil_image), params
+        
+        tier, _ = self.generator.resolve_tier(tier)
+        params = {
+            "prompt": prompt,
+            "cfg_scale": cfg_scale,
+            "top_k": top_k,
+            "top_p": top_p,
+            "seed": seed,
+            "tier": tier
+        }
+        key = self.generator.request_key(prompt, cfg_scale, top_k, top_p, seed, tier)
+        if self.cache is not None:
+            png = await asyncio.to_thread(self.cache.get, key)  # may read from disk
+            if png is not None:
+                return png, params
+        
+        async def generate_png() -> bytes:
+            pil_image, _ = await self.submit(prompt, cfg_scale, top_k, top_p, seed, tier)
+            png = self.generator.pil_to_bytes(pil_image)
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put, key, png)
+            return png
+        
+        return await self.generator.coalesce_async(key, generate_png), params
+    
+    async def submit_samples_png(
+        self,
+        prompt: str,
+        num_images: int = 1,
+        cfg_scale: float = 1.5,
+        top_k: int = 900,
+        top_p: float = 0.96,
+        seed: Optional[int] = None,
+        seeds: Optional[List[int]] = None,
+        tier: Optional[str] = None
+    ) -> Tuple[List[bytes], dict]:
+        """
+        Generate several images of one prompt as PNG bytes, in seed order
+        
+        The samples run as one generate_samples() call on the executor rather than
+        through the micro-batch queue. Image i uses `seeds[i]`, or `seed + i` with a
+        single seed; with either, images are served from and stored in the result
+        cache individually, and identical concurrent requests generate once.
+        """
+        num_images = self.generator.sample_count(num_images, seeds)
+        if seeds is not None:
+            seeds = [int(s) for s in seeds]
+        elif seed is not None:
+            seeds = [seed + i for i in range(num_images)]
+        
+        tier, _ = self.generator.resolve_tier(tier)
+        if seeds is None:
+            pil_images, params = await self.executor.run(
+                self.generator.generate_samples, prompt, num_images, cfg_scale, top_k, top_p, None, tier
+            )
+            return [self.generator.pil_to_bytes(img) for img in pil_images], params
+        
+        params = {
+            "prompt": prompt,
+            "cfg_scale": cfg_scale,
+            "top_k": top_k,
+            "top_p": top_p,
+            "seeds": seeds,
+            "tier": tier
+        }
+        keys = [self.generator.request_key(prompt, cfg_scale, top_k, top_p, s, tier) for s in seeds]
+        pngs: List[Optional[bytes]] = [None] * len(seeds)
+        if self.cache is not None:
+            for i, key in enumerate(keys):
+                pngs[i] = await asyncio.to_thread(self.cache.get, key)
+        missing = [i for i, png in enumerate(pngs) if png is None]
+        if not missing:
+            return pngs, params
+        
+        async def generate_missing() -> List[bytes]:
+            pil_images, _ = await self.executor.run(
+                self.generator.generate_samples, prompt, len(missing), cfg_scale, top_k, top_p, 
+                [seeds[i] for i in missing], tier
+            )
+            missing_pngs = [self.generator.pil_to_bytes(img) for img in pil_images]
+            if self.cache is not None:
+                for i, png in zip(missing, missing_pngs):
+                    await asyncio.to_thread(self.cache.put, keys[i], png)
+            return missing_pngs
+        
+        missing_pngs = await self.generator.coalesce_async(tuple(keys[i] for i in missing), generate_missing)
+        for i, png in zip(missing, missing_pngs):
+            pngs[i] = png
+        return pngs, params
+    
+    async def _collect(self) -> List[_PendingRequest]:
+        batch = [await self._queue.get()]
+        deadline = batch[0].enqueued_at + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            # Requests that queued up while the previous batch ran join immediately
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.executor.max_workers)
+        while True:
+            await slots.acquire()
+            batch = await self._collect()
+            task = loop.create_task(self._dispatch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+            task.add_done_callback(lambda _: slots.release())
+    
+    async def _dispatch(self, batch: List[_PendingRequest]):
+        batch = [r for r in batch if not r.future.done()]
+        
+        # All rows of a forward pass stop at the same stage: one pass per tier, fastest first
+        groups: Dict[str, List[_PendingRequest]] = {}
+        for request in batch:
+            groups.setdefault(request.tier, []).append(request)
+        for tier in sorted(groups, key=lambda t: self.generator.resolve_tier(t)[1]):
+            await self._dispatch_group(groups[tier])
+    
+    async def _dispatch_group(self, batch: List[_PendingRequest]):
+        now = time.perf_counter()
+        self.stats.record(len(batch), [(now - r.enqueued_at) * 1000 for r in batch])
+        
+        try:
+            results = await self.executor.run(self._generate, batch)
+        except QueueFullError as e:
+            results = [e] * len(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                results = [e]
+            else:
+                # Don't let one bad request fail its neighbours: retry them one by one
+                results = [await self._generate_alone(request) for request in batch]
+        
+        for request, result in zip(batch, results):
+            if request.future.done():
+                continue
+            if isinstance(result, Exception):
+                request.future.set_exception(result)
+            else:
+                request.future.set_result(result)
+    
+    async def _generate_alone(self, request: _PendingRequest):
+        try:
+            results = await self.executor.run(self._generate, [request])
+            return results[0]
+        except Exception as e:
+            return e
+    
+    def _generate(self, batch: List[_PendingRequest]) -> List[Tuple[Image.Image, dict]]:
+        images, _ = self.generator.generate_batch(
+            prompts=[r.prompt for r in batch],
+            cfg_scale=[r.cfg_scale for r in batch],
+            top_k=[r.top_k for r in batch],
+            top_p=[r.top_p for r in batch],
+            seed=[r.seed for r in batch],
+            tier=batch[0].tier
+        )
+        return [
+            (image, {
+                "prompt": r.prompt,
+                "cfg_scale": r.cfg_scale,
+                "top_k": r.top_k,
+                "top_p": r.top_p,
+                "seed": r.seed,
+                "tier": r.tier
+            })
+            for image, r in zip(images, batch)
+        ]
+
+
+# Global batcher instance
+batcher = MicroBatcher(
+    generator,
+    inference_executor,
+    max_batch_size=app_config.microbatch_max_size,
+    max_wait_ms=app_config.microbatch_max_wait_ms,
+    max_queue=app_config.inference_queue_size,
+    cache=result_cache
+)
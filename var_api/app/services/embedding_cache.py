@@ -0,0 +1,139 @@
+# ===== app/services/embedding_cache.py =====
+
+"""Prompt embedding cache: in-memory LRU with an optional persistent disk tier"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import numpy as np
+import torch
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Cache key for a prompt: lowercased with whitespace collapsed, as the CLIP tokenizer sees it"""
+    return " ".join(prompt.lower().split())
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of text embeddings keyed on the normalized prompt
+    
+    Up to `max_entries` embeddings stay in memory on the model device. With a
+    `disk_dir`, every embedding is also written there as a .npy file, so misses
+    fall back to disk before running the text encoder, and the directory can be
+    pre-seeded (see scripts/seed_prompt_cache.py) and survives restarts.
+    """
+    
+    def __init__(self, max_entries: int = 4096, disk_dir: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+    
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.npy"
+    
+    def _put(self, key: str, emb: torch.Tensor):
+        with self._lock:
+            self._entries[key] = emb
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def _get(self, key: str, device: torch.device) -> Optional[torch.Tensor]:
+        with self._lock:
+            emb = self._entries.get(key)
+            if emb is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return emb
+        
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        if not path.exists():
+            return None
+        try:
+            emb = torch.from_numpy(np.load(path)).to(device)
+        except (OSError, ValueError):
+            return None  # partial or corrupt file, recompute it
+        self._put(key, emb)
+        with self._lock:
+            self.disk_hits += 1
+        return emb
+    
+    def _save(self, key: str, emb: torch.Tensor):
+        # Write to a temporary file and rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, emb.cpu().numpy())
+            os.replace(tmp, self._disk_path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    
+    def get_or_encode(
+        self,
+        prompts: List[str],
+        encode: Callable[[List[str]], torch.Tensor],
+        device: torch.device
+    ) -> torch.Tensor:
+        """
+        Look up the embeddings of `prompts`, encoding the misses in one batch
+        
+        Args:
+            prompts: Text prompts
+            encode: Encoder for a list of prompts, returning [n, D]
+            device: Device of the returned embeddings
+        
+        Returns:
+            Embeddings [len(prompts), D], in prompt order
+        """
+        keys = [normalize_prompt(p) for p in prompts]
+        found = {}
+        for key in keys:
+            if key not in found:
+                emb = self._get(key, device)
+                if emb is not None:
+                    found[key] = emb
+        
+        missing = [k for k in dict.fromkeys(keys) if k not in found]
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+            for key, emb in zip(missing, encode(missing)):
+                emb = emb.clone()  # don't keep the whole batch alive through a view
+                found[key] = emb
+                self._put(key, emb)
+                if self.disk_dir is not None:
+                    self._save(key, emb)
+        
+        return torch.stack([found[k] for k in keys])
+    
+    def clear(self):
+        """Drop the in-memory entries (the disk tier is kept)"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_dir": str(self.disk_dir) if self.disk_dir is not None else None,
+            }
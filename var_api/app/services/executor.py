@@ -0,0 +1,127 @@
+# ===== app/services/executor.py =====
+
+"""Dedicated executor for blocking inference with bounded concurrency and backpressure"""
+
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator
+
+from app.config import app_config
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the inference queue is full; callers should retry after `retry_after` seconds"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__("Server busy: inference queue is full, retry later")
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """
+    Runs blocking model calls off the event loop
+    
+    At most `max_workers` jobs run at once and at most `max_queue` more may wait.
+    Beyond that, submissions fail immediately with QueueFullError instead of
+    queuing forever.
+    """
+    
+    def __init__(self, max_workers: int = 1, max_queue: int = 16, retry_after_s: int = 5):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after_s = retry_after_s
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._rejected = 0
+    
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Submit a job, or raise QueueFullError if the queue is full"""
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise QueueFullError(self.retry_after_s)
+            self._pending += 1
+        
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._job_done(None)
+            raise
+        future.add_done_callback(self._job_done)
+        return future
+    
+    def _job_done(self, _):
+        with self._lock:
+            self._pending -= 1
+    
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Run a job on the executor and await its result"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+    
+    def run_sync(self, fn: Callable, *args, **kwargs):
+        """Run a job on the executor and block until its result (for sync callers)"""
+        return self.submit(fn, *args, **kwargs).result()
+    
+    def stream(self, fn: Callable[..., Iterator], *args, **kwargs) -> AsyncIterator:
+        """
+        Run a generator function as one job and iterate its items from the event loop
+        
+        Admission happens here, so QueueFullError is raised before any item is
+        produced. If the consumer stops early, the job stops after its current item.
+        Must be called from the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+        
+        def job():
+            items = fn(*args, **kwargs)
+            try:
+                for item in items:
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+                    if stop.is_set():
+                        break
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (done, e))
+                return
+            finally:
+                if hasattr(items, 'close'):
+                    items.close()
+            loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+        
+        self.submit(job)
+        
+        async def drain():
+            try:
+                while True:
+                    item, error = await queue.get()
+                    if item is done:
+                        if error is not None:
+                            raise error
+                        return
+                    yield item
+            finally:
+                stop.set()
+        
+        return drain()
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": min(self._pending, self.max_workers),
+                "queued": max(self._pending - self.max_workers, 0),
+                "rejected": self._rejected,
+            }
+
+
+# Global inference executor
+inference_executor = InferenceExecutor(
+    max_workers=app_config.inference_workers,
+    max_queue=app_config.inference_queue_size,
+    retry_after_s=app_config.inference_retry_after_s
+)
@@ -1,8 +1,13 @@
 # ===== app/services/generator.py =====
 
 import io
+import asyncio
 import base64
-from typing import List, Optional, Tuple
+import secrets
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple, Union
 import numpy as np
 from PIL import Image
 
@@ -11,90 +16,279 @@ import torch.nn.functional as F
 import open_clip
 
 from app.config import app_config, model_config
-from app.models import VQVAE, VAR
+from app.models import VQVAE, VAR, autocast
+from .embedding_cache import PromptEmbeddingCache
+from .executor import QueueFullError, inference_executor
+from .result_cache import ResultCache
+from .weights import load_checkpoint
 
 
 class ImageGenerator:
     """Service for generating images from text prompts"""
     
+    # Startup stages reported by /api/ready, in order
+    LOAD_STAGES = ('weights', 'vae', 'var', 'clip', 'warmup')
+    
     def __init__(self):
         self.device = torch.device(app_config.device)
         self.vae: Optional[VQVAE] = None
         self.var: Optional[VAR] = None
         self.clip_model = None
+        self.clip_dtype: Optional[torch.dtype] = None
         self.tokenizer = None
+        self.prompt_cache: Optional[PromptEmbeddingCache] = None
         self._loaded = False
+        self._load_lock = threading.Lock()
+        self.load_progress = {stage: 'pending' for stage in self.LOAD_STAGES}
+        self.load_error: Optional[str] = None
+        
+        # Single-flight: futures of the deterministic requests currently in flight
+        self._inflight: Dict[Hashable, Future] = {}
+        self._inflight_lock = threading.Lock()
+        self.coalesced = 0
     
     @property
     def is_loaded(self) -> bool:
         return self._loaded
     
+    @property
+    def is_ready(self) -> bool:
+        """Models loaded and warmed up, so latency matches steady state"""
+        return self._loaded and self.load_progress['warmup'] == 'done'
+    
+    @property
+    def model_version(self) -> str:
+        """Everything besides the request that determines an image, for result cache keys"""
+        version = f"{app_config.hf_repo_id}:{app_config.model_version}:{self.device.type}:{model_config.var_attn_backend}"
+        # Other settings that change pixels, appended only when off their defaults so
+        # existing keys stay valid
+        if model_config.var_cfg_schedule is not None:
+            version += ":cfg=" + ",".join(f"{float(w):g}" for w in model_config.var_cfg_schedule)
+        dtypes = (model_config.var_dtype, model_config.vae_dtype, model_config.clip_dtype)
+        if dtypes != ('float32',) * 3:
+            version += ":" + "/".join(dtypes)
+        if app_config.vae_channels_last:
+            version += ":channels_last"
+        return version
+    
+    def request_key(
+        self, 
+        prompt: str, 
+        cfg_scale: float, 
+        top_k: int, 
+        top_p: float, 
+        seed: int, 
+        tier: Optional[str] = None
+    ) -> str:
+        """Content hash of a seeded request, which fully determines its image"""
+        _, max_stage = self.resolve_tier(tier)
+        return ResultCache.key(prompt, cfg_scale, top_k, top_p, seed, self.model_version, max_stage)
+    
+    @staticmethod
+    def resolve_tier(tier: Optional[str]) -> Tuple[str, int]:
+        """Quality tier name (default if None) and the last VAR stage it runs"""
+        tier = tier or app_config.default_tier
+        if tier not in app_config.quality_tiers:
+            raise ValueError(f"Unknown tier '{tier}', expected one of {sorted(app_config.quality_tiers)}")
+        return tier, app_config.quality_tiers[tier]
+    
+    def _join_inflight(self, key: Hashable) -> Tuple[Future, bool]:
+        """Future of the in-flight request `key`, and whether the caller must compute it"""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._inflight[key] = Future()
+            return future, True
+    
+    def _settle_inflight(self, key: Hashable, future: Future, result: Any = None, error: BaseException = None):
+        with self._inflight_lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    
+    def coalesce(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Run `fn` once for all concurrent callers with the same key
+        
+        Only for deterministic work (e.g. keyed on request_key): callers that arrive
+        while the first one is computing wait for and share its result or error.
+        """
+        future, leader = self._join_inflight(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._settle_inflight(key, future, error=e)
+            raise
+        self._settle_inflight(key, future, result)
+        return result
+    
+    async def coalesce_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """coalesce() for coroutines; followers wait without blocking the event loop"""
+        future, leader = self._join_inflight(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._settle_inflight(key, future, error=e)
+            raise
+        self._settle_inflight(key, future, result)
+        return result
+    
+    def inflight_stats(self) -> dict:
+        with self._inflight_lock:
+            return {"in_flight": len(self._inflight), "coalesced": self.coalesced}
+    
+    @contextmanager
+    def _load_stage(self, stage: str):
+        """Track one startup stage in load_progress"""
+        self.load_progress[stage] = 'loading'
+        try:
+            yield
+        except Exception:
+            self.load_progress[stage] = 'failed'
+            raise
+        self.load_progress[stage] = 'done'
+    
     def load_models(self):
-        """Load all required models"""
-        print(f"Loading models on device: {self.device}")
-        
-        # Download weights first
-        print("Downloading weights from HF Hub...")
-        app_config.download_weights()
-        
-        # Load VAE
-        print("Loading VAE...")
-        self.vae = VQVAE(
-            vocab_size=model_config.vocab_size,
-            z_channels=model_config.Cvae,
-            ch=model_config.ch,
-            v_patch_nums=model_config.patch_nums,
-            test_mode=True
-        ).to(self.device)
-        
-        vae_state = torch.load(app_config.vae_path, map_location='cpu', weights_only=False)
-        self.vae.load_state_dict(vae_state, strict=False)
-        self.vae.eval()
-        print("✓ VAE loaded")
-        
-        # Load VAR
-        print("Loading VAR...")
-        self.var = VAR(
-            vae_local=self.vae,
-            n_cond_embed=model_config.n_cond_embed,
-            depth=model_config.var_depth,
-            embed_dim=model_config.var_embed_dim,
-            num_heads=model_config.var_num_heads,
-            mlp_ratio=model_config.var_mlp_ratio,
-            drop_rate=0.,
-            attn_drop_rate=0.,
-            drop_path_rate=model_config.var_drop_path,
-            attn_l2_norm=model_config.var_attn_l2_norm,
-            cond_drop_rate=model_config.var_cond_drop,
-            patch_nums=model_config.patch_nums,
-        ).to(self.device)
-        
-        var_state = torch.load(app_config.model_path, map_location='cpu', weights_only=False)
-        self.var.load_state_dict(var_state['model'])
-        self.var.eval()
-        print("✓ VAR loaded")
-        
-        # Load CLIP
-        print("Loading CLIP...")
-        self.clip_model, _, _ = open_clip.create_model_and_transforms(
-            'ViT-L-14', 
-            pretrained='laion2b_s32b_b82k'
+        """Load all required models (no-op if already loaded)"""
+        with self._load_lock:
+            if self._loaded:
+                return
+            
+            print(f"Loading models on device: {self.device}")
+            
+            # Download weights first
+            with self._load_stage('weights'):
+                print("Downloading weights from HF Hub...")
+                app_config.download_weights()
+            
+            # Load VAE
+            with self._load_stage('vae'):
+                print("Loading VAE...")
+                self.vae = VQVAE(
+                    vocab_size=model_config.vocab_size,
+                    z_channels=model_config.Cvae,
+                    ch=model_config.ch,
+                    v_patch_nums=model_config.patch_nums,
+                    test_mode=True,
+                    inference_only=True,
+                    channels_last=app_config.vae_channels_last,
+                    decode_memory_mb=app_config.vae_decode_memory_mb,
+                    compute_dtype=model_config.inference_dtypes(self.device)['vae']
+                )
+                
+                # assign=True adopts the loaded tensors instead of copying them (torch>=2.1)
+                vae_state = load_checkpoint(app_config.vae_path)
+                self.vae.load_state_dict(vae_state, strict=False, assign=True)
+                self.vae.to(self.device).eval()
+                print("✓ VAE loaded")
+            
+            # Load VAR
+            with self._load_stage('var'):
+                print("Loading VAR...")
+                self.var = VAR(
+                    vae_local=self.vae,
+                    n_cond_embed=model_config.n_cond_embed,
+                    depth=model_config.var_depth,
+                    embed_dim=model_config.var_embed_dim,
+                    num_heads=model_config.var_num_heads,
+                    mlp_ratio=model_config.var_mlp_ratio,
+                    drop_rate=0.,
+                    attn_drop_rate=0.,
+                    drop_path_rate=model_config.var_drop_path,
+                    attn_l2_norm=model_config.var_attn_l2_norm,
+                    cond_drop_rate=model_config.var_cond_drop,
+                    patch_nums=model_config.patch_nums,
+                    attn_backend=model_config.var_attn_backend,
+                    inference_only=True,
+                    prefix_cache_size=model_config.var_prefix_cache_size,
+                    cfg_schedule=model_config.var_cfg_schedule,
+                    compute_dtype=model_config.inference_dtypes(self.device)['var']
+                )
+                
+                var_state = load_checkpoint(app_config.model_path, key='model')
+                self.var.load_state_dict(var_state, assign=True)
+                self.var.to(self.device)
+                self.var.freeze_for_inference()
+                print("✓ VAR loaded")
+            
+            # Load CLIP
+            with self._load_stage('clip'):
+                self.load_text_encoder()
+            
+            self._loaded = True
+            print("\n✓ All models loaded successfully!")
+    
+    def load_text_encoder(self):
+        """Load the CLIP text tower and the prompt embedding cache"""
+        print("Loading CLIP text encoder...")
+        clip_model = open_clip.create_model(
+            model_config.clip_model, 
+            pretrained=model_config.clip_pretrained
         )
-        self.clip_model = self.clip_model.to(self.device).eval()
-        self.tokenizer = open_clip.get_tokenizer('ViT-L-14')
+        # Only encode_text is used: drop the vision tower before moving to the device
+        clip_model.visual = None
+        self.clip_model = clip_model.to(self.device).eval().requires_grad_(False)
+        self.clip_dtype = model_config.inference_dtypes(self.device)['clip']
+        self.tokenizer = open_clip.get_tokenizer(model_config.clip_model)
+        
+        disk_dir = None
+        if app_config.prompt_cache_subdir is not None:
+            disk_dir = (
+                app_config.cache_dir / app_config.prompt_cache_subdir 
+                / f"{model_config.clip_model}-{model_config.clip_pretrained}"
+            )
+            if self.clip_dtype is not None:
+                # Low-precision embeddings differ slightly: keep them apart from float32 ones
+                disk_dir = disk_dir.with_name(f"{disk_dir.name}-{model_config.clip_dtype}")
+        self.prompt_cache = PromptEmbeddingCache(app_config.prompt_cache_size, disk_dir)
         print("✓ CLIP loaded")
+    
+    def warmup(self, batch_sizes: Sequence[int] = (1,)):
+        """
+        Run one generation per batch size so allocator and caches reach steady state
         
-        self._loaded = True
-        print("\n✓ All models loaded successfully!")
-
+        Each run goes through the inference executor, so warmup never overlaps
+        requests that arrive once the models are loaded.
+        """
+        with self._load_stage('warmup'):
+            for batch_size in batch_sizes:
+                print(f"Warming up (batch size {batch_size})...")
+                try:
+                    inference_executor.run_sync(
+                        self.generate_batch, ["a beautiful red rose flower"] * batch_size, seed=0
+                    )
+                except QueueFullError:
+                    print("✓ Warmup skipped: inference queue is already busy with requests")
+                    return
+            print("✓ Warmup done")
     
+    def preload(self, warmup_batch_sizes: Sequence[int] = (1,)):
+        """Load models and warm up, recording failures in load_error instead of raising"""
+        try:
+            self.load_models()
+            self.warmup(warmup_batch_sizes)
+        except Exception as e:
+            self.load_error = str(e)
+            print(f"✗ Model preload failed: {e}")
     
-    @torch.no_grad()
     def encode_text(self, texts: List[str]) -> torch.Tensor:
-        """Encode text prompts using CLIP"""
+        """Encode text prompts using CLIP, through the prompt embedding cache"""
+        return self.prompt_cache.get_or_encode(texts, self._encode_text, self.device)
+    
+    @torch.no_grad()
+    def _encode_text(self, texts: List[str]) -> torch.Tensor:
         tokens = self.tokenizer(texts).to(self.device)
-        emb = self.clip_model.encode_text(tokens)
-        return F.normalize(emb, dim=-1).float()
+        with autocast(self.device.type, self.clip_dtype):
+            emb = self.clip_model.encode_text(tokens)
+        return F.normalize(emb.float(), dim=-1)
     
     @staticmethod
     def tensor_to_pil(tensor: torch.Tensor) -> Image.Image:
@@ -119,23 +313,53 @@ class ImageGenerator:
         buffer.seek(0)
         return buffer.getvalue()
     
+    @staticmethod
+    def _random_seed() -> int:
+        """Draw a seed from OS entropy, small enough to round-trip through JSON clients"""
+        return secrets.randbelow(2 ** 31)
+    
+    def resolve_seeds(
+        self, 
+        seed: Union[int, Sequence[Optional[int]], None], 
+        n: int
+    ) -> Union[int, List[int]]:
+        """
+        Replace missing seeds with fresh random ones
+        
+        Every generation then runs from an explicit per-request RNG and the seed
+        reported back to the caller reproduces it.
+        """
+        if seed is None:
+            return self._random_seed() if n == 1 else [self._random_seed() for _ in range(n)]
+        if isinstance(seed, int):
+            return seed
+        return [self._random_seed() if s is None else int(s) for s in seed]
+    
     def generate(
         self,
         prompt: str,
         cfg_scale: float = 1.5,
         top_k: int = 900,
         top_p: float = 0.96,
-        seed: Optional[int] = None
+        seed: Optional[int] = None,
+        tier: Optional[str] = None
     ) -> Tuple[Image.Image, dict]:
         """
         Generate a single image from text prompt
         
+        Without a seed a random one is drawn; the seed used is reported in the parameters.
+        A quality tier (app_config.quality_tiers) may stop generation at a coarser
+        scale for lower latency; it is reported in the parameters too.
+        
         Returns:
             Tuple of (PIL Image, generation parameters)
         """
         if not self._loaded:
             raise RuntimeError("Models not loaded. Call load_models() first.")
         
+        seed = self.resolve_seeds(seed, 1)
+        tier, max_stage = self.resolve_tier(tier)
+        
         # Encode text
         text_emb = self.encode_text([prompt])
         
@@ -146,7 +370,8 @@ class ImageGenerator:
                 cfg=cfg_scale,
                 top_k=top_k,
                 top_p=top_p,
-                seed=seed
+                seed=seed,
+                max_stage=max_stage
             )[0]
         
         # Convert to PIL
@@ -157,22 +382,350 @@ class ImageGenerator:
             "cfg_scale": cfg_scale,
             "top_k": top_k,
             "top_p": top_p,
-            "seed": seed
+            "seed": seed,
+            "tier": tier
         }
         
         return pil_image, params
     
-    def generate_batch(
+    def generate_progressive(
         self,
-        prompts: List[str],
+        prompt: str,
+        cfg_scale: float = 1.5,
+        top_k: int = 900,
+        top_p: float = 0.96,
+        seed: Optional[int] = None,
+        preview_stages: Sequence[int] = (),
+        tier: Optional[str] = None
+    ) -> Iterator[Tuple[int, Image.Image, Optional[dict]]]:
+        """
+        Generate a single image, yielding previews after the chosen stages
+        
+        Previews are decoded at the stage's patch resolution (16x upsampled), so the
+        early ones are small and cheap. The final image is the same as generate().
+        
+        Yields:
+            (stage index, preview PIL Image, None) per preview stage, then
+            (last stage index, final PIL Image, generation parameters)
+        """
+        if not self._loaded:
+            raise RuntimeError("Models not loaded. Call load_models() first.")
+        
+        seed = self.resolve_seeds(seed, 1)
+        tier, max_stage = self.resolve_tier(tier)
+        text_emb = self.encode_text([prompt])
+        
+        stages = self.var.generate_progressive(
+            text_emb,
+            cfg=cfg_scale,
+            top_k=top_k,
+            top_p=top_p,
+            seed=seed,
+            preview_stages=preview_stages,
+            max_stage=max_stage
+        )
+        for si, image_tensors in stages:
+            if si < max_stage:
+                yield si, self.tensor_to_pil(image_tensors[0]), None
+        
+        params = {
+            "prompt": prompt,
+            "cfg_scale": cfg_scale,
+            "top_k": top_k,
+            "top_p": top_p,
+            "seed": seed,
+            "tier": tier
+        }
+        yield si, self.tensor_to_pil(image_tensors[0]), params
+    
+    def generate_samples(
+        self,
+        prompt: str,
+        num_images: int = 1,
         cfg_scale: float = 1.5,
         top_k: int = 900,
         top_p: float = 0.96,
-        seed: Optional[int] = None
+        seed: Union[int, Sequence[Optional[int]], None] = None,
+        tier: Optional[str] = None,
+        return_tokens: bool = False
+    ) -> Tuple[List[Image.Image], dict]:
+        """
+        Generate several images of one prompt
+        
+        The prompt is encoded and its conditioning computed once for all samples,
+        which run as one batch. A single seed gives image i the seed `seed + i`; a seed
+        list gives one image per seed, in that order. Each image is the same as
+        generating it alone with its seed.
+        
+        With return_tokens, the parameters also hold each image's token indices
+        (see pack_tokens), which vary() takes to re-sample only the fine stages.
+        
+        Returns:
+            Tuple of (list of PIL Images in seed order, generation parameters)
+        """
+        if not self._loaded:
+            raise RuntimeError("Models not loaded. Call load_models() first.")
+        
+        seeds = self._sample_seeds(seed, num_images)
+        tier, max_stage = self.resolve_tier(tier)
+        
+        # Encode text once
+        text_emb = self.encode_text([prompt])
+        
+        # Generate
+        with torch.no_grad():
+            image_tensors, tokens = self.var.generate(
+                text_emb,
+                cfg=cfg_scale,
+                top_k=top_k,
+                top_p=top_p,
+                seed=seeds,
+                num_samples=len(seeds),
+                max_stage=max_stage,
+                return_tokens=True
+            )
+        
+        # Convert to PIL
+        pil_images = [self.tensor_to_pil(t) for t in image_tensors]
+        
+        params = {
+            "prompt": prompt,
+            "cfg_scale": cfg_scale,
+            "top_k": top_k,
+            "top_p": top_p,
+            "seeds": seeds,
+            "tier": tier
+        }
+        if return_tokens:
+            params["tokens"] = [self.pack_tokens([t[i] for t in tokens]) for i in range(len(seeds))]
+        
+        return pil_images, params
+    
+    def vary(
+        self,
+        prompt: str,
+        tokens: str,
+        keep_stages: int,
+        num_images: int = 1,
+        cfg_scale: float = 1.5,
+        top_k: int = 900,
+        top_p: float = 0.96,
+        seed: Union[int, Sequence[Optional[int]], None] = None,
+        tier: Optional[str] = None
+    ) -> Tuple[List[Image.Image], dict]:
+        """
+        Re-sample the fine stages of an earlier image, keeping its composition
+        
+        The first `keep_stages` stages of `tokens` (from return_tokens) are replayed
+        instead of sampled, and the remaining stages are sampled with the new seeds,
+        so a variation costs only the finer stages. With the image's own prompt,
+        settings and seed, the image itself is reproduced.
+        
+        Returns:
+            Tuple of (list of PIL Images in seed order, generation parameters,
+            including each image's tokens)
+        """
+        if not self._loaded:
+            raise RuntimeError("Models not loaded. Call load_models() first.")
+        
+        seeds = self._sample_seeds(seed, num_images)
+        tier, max_stage = self.resolve_tier(tier)
+        prefix_tokens = self.unpack_tokens(tokens)
+        if not 1 <= keep_stages <= min(len(prefix_tokens), max_stage):
+            raise ValueError(
+                f"keep_stages must be in [1, {min(len(prefix_tokens), max_stage)}] "
+                f"for tokens of {len(prefix_tokens)} stages and tier '{tier}'"
+            )
+        
+        text_emb = self.encode_text([prompt])
+        
+        with torch.no_grad():
+            image_tensors, new_tokens = self.var.generate(
+                text_emb,
+                cfg=cfg_scale,
+                top_k=top_k,
+                top_p=top_p,
+                seed=seeds,
+                num_samples=len(seeds),
+                max_stage=max_stage,
+                prefix_tokens=[t.to(self.device) for t in prefix_tokens[:keep_stages]],
+                return_tokens=True
+            )
+        
+        pil_images = [self.tensor_to_pil(t) for t in image_tensors]
+        
+        params = {
+            "prompt": prompt,
+            "cfg_scale": cfg_scale,
+            "top_k": top_k,
+            "top_p": top_p,
+            "seeds": seeds,
+            "tier": tier,
+            "keep_stages": keep_stages,
+            "tokens": [self.pack_tokens([t[i] for t in new_tokens]) for i in range(len(seeds))]
+        }
+        
+        return pil_images, params
+    
+    def generate_tokens(
+        self,
+        prompt: str,
+        num_images: int = 1,
+        cfg_scale: float = 1.5,
+        top_k: int = 900,
+        top_p: float = 0.96,
+        seed: Union[int, Sequence[Optional[int]], None] = None,
+        tier: Optional[str] = None
+    ) -> Tuple[List[str], dict]:
+        """
+        Sample images of one prompt like generate_samples(), without decoding them
+        
+        Each image is returned as its packed token indices (see pack_tokens), about
+        1.4 KB for a full image; decode_tokens() renders them later.
+        
+        Returns:
+            Tuple of (packed tokens per image in seed order, generation parameters)
+        """
+        if not self._loaded:
+            raise RuntimeError("Models not loaded. Call load_models() first.")
+        
+        seeds = self._sample_seeds(seed, num_images)
+        tier, max_stage = self.resolve_tier(tier)
+        text_emb = self.encode_text([prompt])
+        
+        with torch.no_grad():
+            tokens = self.var.generate_tokens(
+                text_emb,
+                cfg=cfg_scale,
+                top_k=top_k,
+                top_p=top_p,
+                seed=seeds,
+                num_samples=len(seeds),
+                max_stage=max_stage
+            )
+        
+        params = {
+            "prompt": prompt,
+            "cfg_scale": cfg_scale,
+            "top_k": top_k,
+            "top_p": top_p,
+            "seeds": seeds,
+            "tier": tier
+        }
+        
+        return [self.pack_tokens([t[i] for t in tokens]) for i in range(len(seeds))], params
+    
+    def decode_tokens(self, tokens: Sequence[str]) -> List[Image.Image]:
+        """
+        Render packed token indices (see pack_tokens) into images, in order
+        
+        Token sets with the same number of stages are reconstructed together, then
+        decoded as one batch.
+        """
+        if not self._loaded:
+            raise RuntimeError("Models not loaded. Call load_models() first.")
+        if len(tokens) > app_config.decode_max_items:
+            raise ValueError(f"Maximum {app_config.decode_max_items} token sets allowed")
+        
+        # Group by stage count, since idx_to_fhat needs whole stages for the batch
+        groups: Dict[int, List[Tuple[int, List[torch.Tensor]]]] = {}
+        for i, data in enumerate(tokens):
+            stages = self.unpack_tokens(data)
+            groups.setdefault(len(stages), []).append((i, stages))
+        
+        order, f_hats = [], []
+        with torch.no_grad():
+            for group in groups.values():
+                ms_idx_Bl = [
+                    torch.cat([stages[si] for _, stages in group]).to(self.device)
+                    for si in range(len(group[0][1]))
+                ]
+                f_hats.append(self.vae.quantize.idx_to_fhat(ms_idx_Bl))
+                order.extend(i for i, _ in group)
+            
+            # The decoder splits the batch itself to stay within app_config.vae_decode_memory_mb
+            image_tensors = self.vae.fhat_to_img(torch.cat(f_hats)).add_(1).mul_(0.5)
+        
+        images = [None] * len(tokens)
+        for i, t in zip(order, image_tensors):
+            images[i] = self.tensor_to_pil(t)
+        return images
+    
+    @staticmethod
+    def sample_count(num_images: int, seed: Union[int, Sequence[Optional[int]], None]) -> int:
+        """
+        Number of images requested by num_images and seed
+        
+        With a seed list, num_images must be 1 (the default) or the number of seeds.
+        """
+        if seed is not None and not isinstance(seed, int):
+            if num_images not in (1, len(seed)):
+                raise ValueError(f"num_images must be 1 or the number of seeds ({len(seed)})")
+            num_images = len(seed)
+        if num_images < 1:
+            raise ValueError("At least one image must be requested")
+        if num_images > app_config.max_batch_size:
+            raise ValueError(f"Maximum {app_config.max_batch_size} images allowed")
+        return num_images
+    
+    def _sample_seeds(self, seed: Union[int, Sequence[Optional[int]], None], num_images: int) -> List[int]:
+        """Per-image seeds: `seed + i` for a single seed, else the list with missing ones drawn"""
+        num_images = self.sample_count(num_images, seed)
+        if isinstance(seed, int):
+            return [seed + i for i in range(num_images)]
+        return self.resolve_seeds(list(seed) if seed is not None else [None] * num_images, num_images)
+    
+    @staticmethod
+    def pack_tokens(stage_tokens: Sequence[torch.Tensor]) -> str:
+        """One image's token indices, all stages concatenated, as base64 of little-endian uint16"""
+        flat = torch.cat([t.reshape(-1) for t in stage_tokens]).cpu().numpy().astype('<u2')
+        return base64.b64encode(flat.tobytes()).decode()
+    
+    @staticmethod
+    def unpack_tokens(data: str) -> List[torch.Tensor]:
+        """
+        Per-stage token indices from pack_tokens() output
+        
+        Returns:
+            One [1, pn * pn] long tensor per stage, for as many stages as were packed
+        """
+        try:
+            raw = base64.b64decode(data, validate=True)
+        except ValueError:
+            raise ValueError("tokens must be base64")
+        if len(raw) % 2:
+            raise ValueError("tokens must be uint16 values")
+        flat = np.frombuffer(raw, dtype='<u2').astype(np.int64)
+        if flat.size and flat.max() >= model_config.vocab_size:
+            raise ValueError(f"Token indices must be below the vocabulary size {model_config.vocab_size}")
+        
+        stages, pos = [], 0
+        for pn in model_config.patch_nums:
+            if pos + pn * pn > flat.size:
+                break
+            stages.append(torch.from_numpy(flat[pos:pos + pn * pn].copy()).view(1, pn * pn))
+            pos += pn * pn
+        if not stages or pos != flat.size:
+            raise ValueError("tokens must hold whole stages, starting from stage 0")
+        return stages
+    
+    def generate_batch(
+        self,
+        prompts: List[str],
+        cfg_scale: Union[float, Sequence[float]] = 1.5,
+        top_k: Union[int, Sequence[int]] = 900,
+        top_p: Union[float, Sequence[float]] = 0.96,
+        seed: Union[int, Sequence[Optional[int]], None] = None,
+        tier: Optional[str] = None
     ) -> Tuple[List[Image.Image], dict]:
         """
         Generate multiple images from text prompts
         
+        Each sampling parameter is either shared by all prompts or a list with one
+        value per prompt. A shared seed gives prompt i the seed `seed + i`, and each
+        prompt's image is the same as generating it alone with its seed. Missing seeds
+        are drawn at random and reported in the parameters.
+        
         Returns:
             Tuple of (list of PIL Images, generation parameters)
         """
@@ -182,6 +735,9 @@ class ImageGenerator:
         if len(prompts) > app_config.max_batch_size:
             raise ValueError(f"Maximum {app_config.max_batch_size} prompts allowed")
         
+        seed = self.resolve_seeds(seed, len(prompts))
+        tier, max_stage = self.resolve_tier(tier)
+        
         # Encode texts
         text_emb = self.encode_text(prompts)
         
@@ -192,7 +748,8 @@ class ImageGenerator:
                 cfg=cfg_scale,
                 top_k=top_k,
                 top_p=top_p,
-                seed=seed
+                seed=seed,
+                max_stage=max_stage
             )
         
         # Convert to PIL
@@ -202,7 +759,8 @@ class ImageGenerator:
             "cfg_scale": cfg_scale,
             "top_k": top_k,
             "top_p": top_p,
-            "seed": seed
+            "seed": seed,
+            "tier": tier
         }
         
         return pil_images, params
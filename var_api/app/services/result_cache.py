@@ -0,0 +1,194 @@
+# ===== app/services/result_cache.py =====
+
+"""Content-addressed cache of generated images for fully seeded requests"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from app.config import app_config
+from .embedding_cache import normalize_prompt
+
+
+class ResultCache:
+    """
+    Encoded images keyed on a hash of every input that determines them
+    
+    With a seed, the image is a pure function of (prompt, cfg_scale, top_k, top_p,
+    seed, last stage, model version), so it is stored under a hash of those. Entries are kept
+    in an in-memory LRU bounded by `max_memory_bytes` and, with a `disk_dir`, in
+    files on disk bounded by `max_disk_bytes` (least recently used files go first).
+    """
+    
+    def __init__(
+        self,
+        max_memory_bytes: int = 64 * 2 ** 20,
+        disk_dir: Optional[Path] = None,
+        max_disk_bytes: int = 2 ** 30
+    ):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None  # scanned lazily on first disk access
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def key(
+        prompt: str,
+        cfg_scale: float,
+        top_k: int,
+        top_p: float,
+        seed: int,
+        model_version: str,
+        max_stage: Optional[int] = None
+    ) -> str:
+        """Cache key of one generation"""
+        inputs = [
+            model_version, normalize_prompt(prompt), float(cfg_scale), int(top_k), float(top_p), int(seed), max_stage
+        ]
+        return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        """Cached image bytes for `key`, or None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._memory_put(key, data)
+        return data
+    
+    def put(self, key: str, data: bytes):
+        """Store image bytes under `key`"""
+        self._memory_put(key, data)
+        self._disk_put(key, data)
+    
+    def _memory_put(self, key: str, data: bytes):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old)
+            self._entries[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+    
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.bin"
+    
+    def _scan_disk(self):
+        if self._disk_bytes is None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(p.stat().st_size for p in self.disk_dir.glob("*.bin"))
+    
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # mark as recently used for eviction
+        except OSError:
+            return None
+        return data
+    
+    def _disk_put(self, key: str, data: bytes):
+        if self.disk_dir is None or len(data) > self.max_disk_bytes:
+            return
+        with self._disk_lock:
+            self._scan_disk()
+            path = self._disk_path(key)
+            if path.exists():
+                os.utime(path)
+                return
+            
+            # Write to a temporary file and rename, so readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except OSError:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return
+            self._disk_bytes += len(data)
+            
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+    
+    def _evict_disk(self):
+        """Delete least recently used files until the disk tier is at 90% of its budget"""
+        files = []
+        for path in self.disk_dir.glob("*.bin"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        
+        self._disk_bytes = sum(size for _, size, _ in files)
+        target = int(self.max_disk_bytes * 0.9)
+        for _, size, path in files:
+            if self._disk_bytes <= target:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            self._disk_bytes -= size
+    
+    def clear(self):
+        """Drop the in-memory entries (the disk tier is kept)"""
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+    
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+                "disk_bytes": self._disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes if self.disk_dir is not None else None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+# Global result cache
+result_cache = ResultCache(
+    max_memory_bytes=app_config.result_cache_memory_mb * 2 ** 20,
+    disk_dir=(
+        app_config.cache_dir / app_config.result_cache_subdir
+        if app_config.result_cache_subdir is not None else None
+    ),
+    max_disk_bytes=app_config.result_cache_disk_mb * 2 ** 20
+)
@@ -0,0 +1,26 @@
+# ===== app/services/weights.py =====
+
+"""Checkpoint loading: safetensors with a pickle fallback"""
+
+from pathlib import Path
+from typing import Dict, Optional
+
+import torch
+from safetensors.torch import load_file
+
+
+def load_checkpoint(path: Path, key: Optional[str] = None) -> Dict[str, torch.Tensor]:
+    """
+    Load a state dict from a converted .safetensors file or a .pth checkpoint
+    
+    Args:
+        path: Checkpoint file
+        key: Entry holding the state dict inside a .pth checkpoint (e.g. 'model');
+            converted safetensors files store the state dict directly
+    """
+    path = Path(path)
+    if path.suffix == '.safetensors':
+        return load_file(str(path), device='cpu')
+    
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    return state[key] if key is not None else state
@@ -0,0 +1,104 @@
+# ===== scripts/benchmark_decode.py =====
+
+"""Benchmark VAE decoding: the plain NCHW path against VQVAE.fhat_to_img
+
+The plain path runs the whole batch through the decoder in NCHW under no_grad, as
+fhat_to_img did before; the fast path is fhat_to_img with channels_last,
+inference_mode and chunks bounded by the decode memory budget. Every run happens
+in a fresh process, so peak RSS (or peak CUDA memory) is measured per run.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import torch
+
+from app.config import app_config, model_config
+from app.models.vae import VQVAE
+
+
+def _rss_mb() -> float:
+    """Current resident set size of this process"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def _run(path: str, batch_size: int, reps: int, args: argparse.Namespace) -> dict:
+    device = torch.device(args.device)
+    fast = path == "fast"
+    vae = VQVAE(
+        vocab_size=model_config.vocab_size,
+        z_channels=model_config.Cvae,
+        ch=model_config.ch,
+        v_patch_nums=model_config.patch_nums,
+        inference_only=True,
+        channels_last=fast and args.channels_last,
+        decode_memory_mb=args.memory_mb if fast else None
+    )
+    if args.vae is not None:
+        from app.services.weights import load_checkpoint
+        vae.load_state_dict(load_checkpoint(args.vae), strict=False)
+    vae.to(device).eval()
+    vae.freeze_for_inference()
+    
+    HW = model_config.patch_nums[-1]
+    f_hat = torch.randn(batch_size, model_config.Cvae, HW, HW, device=device)
+    
+    def decode():
+        if fast:
+            return vae.fhat_to_img(f_hat)
+        with torch.no_grad():
+            return vae.decoder(vae.post_quant_conv(f_hat)).clamp_(-1, 1)
+    
+    rss_before = _rss_mb()
+    decode()  # warmup
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    
+    start = time.perf_counter()
+    for _ in range(reps):
+        decode()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    return {
+        "images_per_s": batch_size * reps / elapsed,
+        "peak_rss_mb": peak,
+        "decode_rss_mb": peak - rss_before,
+        "peak_cuda_mb": torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == "cuda" else None,
+        "chunk": vae.decode_chunk_size(f_hat),
+    }
+
+
+def benchmark_decode(args: argparse.Namespace):
+    ctx = mp.get_context("spawn")
+    print(f"{'path':6s} {'batch':>5s} {'chunk':>5s} {'img/s':>8s} {'peak RSS MB':>12s} {'decode RSS MB':>14s} {'peak CUDA MB':>13s}")
+    for batch_size in args.batch_sizes:
+        for path in ("plain", "fast"):
+            with ctx.Pool(1) as pool:
+                r = pool.apply(_run, (path, batch_size, args.reps, args))
+            cuda = f"{r['peak_cuda_mb']:13.0f}" if r["peak_cuda_mb"] is not None else f"{'-':>13s}"
+            print(f"{path:6s} {batch_size:5d} {r['chunk']:5d} {r['images_per_s']:8.2f} "
+                  f"{r['peak_rss_mb']:12.0f} {r['decode_rss_mb']:14.0f} {cuda}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8], help="Batch sizes to decode")
+    parser.add_argument("--reps", type=int, default=3, help="Timed decodes per run")
+    parser.add_argument("--device", default=app_config.device, help="Device to run on")
+    parser.add_argument("--memory-mb", type=int, default=app_config.vae_decode_memory_mb, help="Decode memory budget of the fast path")
+    parser.add_argument("--channels-last", action=argparse.BooleanOptionalAction, default=app_config.vae_channels_last, help="channels_last on the fast path")
+    parser.add_argument("--vae", default=None, help="VAE checkpoint to load (random weights otherwise; timing doesn't depend on them)")
+    args = parser.parse_args()
+    
+    benchmark_decode(args)
@@ -0,0 +1,61 @@
+# ===== scripts/convert_checkpoints.py =====
+
+"""Convert the .pth checkpoints to safetensors files holding only the inference tensors
+
+Run once after download_weights.py. ImageGenerator.load_models memory-maps the
+converted files when they are present instead of unpickling the .pth checkpoints.
+"""
+
+import argparse
+import os
+from pathlib import Path
+
+import torch
+from safetensors.torch import save_file
+
+# Configuration
+CHECKPOINT_DIR = os.path.join(os.path.dirname(__file__), "..", "checkpoints")
+OUTPUT_DIR = Path.home() / ".cache" / "var-model"
+VAR_SAFETENSORS = "var.safetensors"
+VAE_SAFETENSORS = "vae.safetensors"
+
+# Training-only entries, skipped by the inference_only models
+VAR_TRAINING_KEYS = ("attn_bias_for_masking",)
+VAE_TRAINING_KEYS = ("encoder.", "quant_conv.", "quantize.ema_vocab_hit_SV")
+
+
+def to_inference_tensors(state: dict, training_keys: tuple = ()) -> dict:
+    """Keep inference tensors only, as standalone contiguous copies (safetensors can't store shared memory)"""
+    return {
+        k: v.detach().clone().contiguous() 
+        for k, v in state.items() 
+        if isinstance(v, torch.Tensor) and not k.startswith(training_keys)
+    }
+
+
+def convert(var_ckpt: Path, vae_ckpt: Path, out_dir: Path):
+    os.makedirs(out_dir, exist_ok=True)
+    
+    # VAR: only the model weights, not the optimizer/trainer state stored beside them
+    var_state = torch.load(var_ckpt, map_location='cpu', weights_only=False)
+    var_tensors = to_inference_tensors(var_state['model'], VAR_TRAINING_KEYS)
+    save_file(var_tensors, str(out_dir / VAR_SAFETENSORS))
+    print(f"✓ VAR: {len(var_tensors)} tensors -> {out_dir / VAR_SAFETENSORS}")
+    
+    # VAE: the checkpoint is a bare state dict; the encoder is not needed for generation
+    vae_state = torch.load(vae_ckpt, map_location='cpu', weights_only=False)
+    vae_tensors = to_inference_tensors(vae_state, VAE_TRAINING_KEYS)
+    save_file(vae_tensors, str(out_dir / VAE_SAFETENSORS))
+    print(f"✓ VAE: {len(vae_tensors)} tensors -> {out_dir / VAE_SAFETENSORS}")
+    
+    print("\n✓ Checkpoints converted successfully!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--var", type=Path, default=Path(CHECKPOINT_DIR) / "ckpt_best.pth", help="VAR .pth checkpoint")
+    parser.add_argument("--vae", type=Path, default=Path(CHECKPOINT_DIR) / "vae_ch160v4096z32.pth", help="VAE .pth checkpoint")
+    parser.add_argument("--out-dir", type=Path, default=OUTPUT_DIR, help="Directory for the .safetensors files")
+    args = parser.parse_args()
+    
+    convert(args.var, args.vae, args.out_dir)
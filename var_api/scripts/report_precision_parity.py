@@ -0,0 +1,108 @@
+# ===== scripts/report_precision_parity.py =====
+
+"""Compare reduced-precision inference against float32 on the real checkpoints
+
+Both policies load the downloaded VAR, VAE and CLIP weights through
+ImageGenerator.load_models, each in a fresh process (weights are cast when the
+models are frozen, so the two can't share one instance). The same prompts and
+fixed seeds are sampled under both, and every (prompt, seed) pair reports the
+CLIP embedding cosine, the fraction of tokens that agree with float32, the first
+stage where they diverge and the PSNR of the image against the float32 one.
+"""
+
+import argparse
+import math
+import multiprocessing as mp
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import torch
+
+from app.config import app_config, model_config
+
+
+def _run(dtypes: dict, prompts: list, seeds: list, args: argparse.Namespace) -> dict:
+    app_config.device = args.device
+    for component, name in dtypes.items():
+        setattr(model_config, f"{component}_dtype", name)
+    
+    from app.services.generator import ImageGenerator
+    generator = ImageGenerator()
+    generator.load_models()
+    
+    embeds, images, tokens = [], [], []
+    for start in range(0, len(prompts), app_config.max_batch_size):
+        batch = slice(start, start + app_config.max_batch_size)
+        embed = generator.encode_text(prompts[batch])
+        with torch.no_grad():
+            img, tok = generator.var.generate(
+                embed, cfg=args.cfg, top_k=args.top_k, top_p=args.top_p,
+                seed=seeds[batch], return_tokens=True
+            )
+        embeds.append(embed.float().cpu().numpy())
+        images.append(img.float().cpu().numpy())
+        tokens.append([t.cpu().numpy() for t in tok])
+    
+    return {
+        "embed": np.concatenate(embeds),
+        "images": np.concatenate(images),
+        "tokens": [np.concatenate(stage) for stage in zip(*tokens)],
+    }
+
+
+def _psnr(a: np.ndarray, b: np.ndarray) -> float:
+    """PSNR of images in range [0, 1]"""
+    mse = float(np.mean((a.astype(np.float64) - b) ** 2))
+    return math.inf if mse == 0 else 10 * math.log10(1 / mse)
+
+
+def report_precision_parity(args: argparse.Namespace):
+    policy = {"var": args.var_dtype, "vae": args.vae_dtype, "clip": args.clip_dtype}
+    pairs = [(prompt, seed) for prompt in args.prompts for seed in args.seeds]
+    prompts, seeds = [p for p, _ in pairs], [s for _, s in pairs]
+    
+    ctx = mp.get_context("spawn")
+    results = {}
+    for name, dtypes in (("float32", {c: "float32" for c in policy}), ("reduced", policy)):
+        with ctx.Pool(1) as pool:
+            results[name] = pool.apply(_run, (dtypes, prompts, seeds, args))
+    ref, low = results["float32"], results["reduced"]
+    
+    print(f"policy: var={args.var_dtype} vae={args.vae_dtype} clip={args.clip_dtype} on {args.device}")
+    print(f"{'prompt':32s} {'seed':>6s} {'CLIP cos':>9s} {'tokens':>7s} {'diverges':>9s} {'PSNR dB':>8s}")
+    psnrs, agreements = [], []
+    for i, (prompt, seed) in enumerate(pairs):
+        a, b = ref["embed"][i], low["embed"][i]
+        cos = float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+        same = [r[i] == l[i] for r, l in zip(ref["tokens"], low["tokens"])]
+        agreement = sum(int(s.sum()) for s in same) / sum(s.size for s in same)
+        diverging = [si for si, s in enumerate(same) if not s.all()]
+        psnr = _psnr(ref["images"][i], low["images"][i])
+        psnrs.append(psnr)
+        agreements.append(agreement)
+        
+        stage = str(diverging[0]) if diverging else "-"
+        print(f"{prompt[:32]:32s} {seed:6d} {cos:9.5f} {agreement:7.2%} {stage:>9s} {psnr:8.2f}")
+    
+    print(f"token agreement: mean {np.mean(agreements):.2%}, min {min(agreements):.2%}")
+    print(f"PSNR dB: median {np.median(psnrs):.2f}, min {min(psnrs):.2f}")
+
+
+if __name__ == "__main__":
+    reduced = "float16" if app_config.device.startswith("cuda") else "bfloat16"
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--prompts", nargs="+", default=["a beautiful red rose flower", "a yellow sunflower in a field"], help="Prompts to sample")
+    parser.add_argument("--seeds", type=int, nargs="+", default=list(range(8)), help="Seeds to sample every prompt with")
+    parser.add_argument("--var-dtype", default=reduced, help="VAR dtype of the reduced policy")
+    parser.add_argument("--vae-dtype", default=reduced, help="VAE dtype of the reduced policy")
+    parser.add_argument("--clip-dtype", default=reduced, help="CLIP dtype of the reduced policy")
+    parser.add_argument("--cfg", type=float, default=1.5, help="Guidance scale")
+    parser.add_argument("--top-k", type=int, default=900, help="Top-k sampling")
+    parser.add_argument("--top-p", type=float, default=0.96, help="Top-p sampling")
+    parser.add_argument("--device", default=app_config.device, help="Device to run on")
+    args = parser.parse_args()
+    
+    report_precision_parity(args)
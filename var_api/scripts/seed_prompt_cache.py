@@ -0,0 +1,81 @@
+# ===== scripts/seed_prompt_cache.py =====
+
+"""Pre-seed the persistent prompt embedding cache with the Oxford-102 caption prompts
+
+Every flower class name is combined with every caption template used to build the
+training captions (dataset_preprocessing.ipynb), so the most common prompts skip the
+CLIP encode from the first request on.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.services.generator import ImageGenerator
+
+# Official Oxford Flowers 102 names
+OFFICIAL_FLOWER_NAMES = [
+    "pink primrose", "hard-leaved pocket orchid", "canterbury bells",
+    "sweet pea", "english marigold", "tiger lily", "moon orchid",
+    "bird of paradise", "monkshood", "globe thistle", "snapdragon",
+    "colt's foot", "king protea", "spear thistle", "yellow iris",
+    "globe", "purple coneflower", "peruvian lily",
+    "balloon", "giant white arum lily", "fire lily",
+    "pincushion", "fritillary", "red ginger", "grape hyacinth",
+    "corn poppy", "prince of wales feathers", "stemless gentian",
+    "artichoke", "sweet william", "carnation", "garden phlox",
+    "love in the mist", "mexican aster", "alpine sea holly",
+    "ruby-lipped cattleya", "cape", "great masterwort",
+    "siam tulip", "lenten rose", "barbeton daisy", "daffodil",
+    "sword lily", "poinsettia", "bolero deep blue", "wall",
+    "marigold", "buttercup", "oxeye daisy", "common dandelion",
+    "petunia", "wild pansy", "primula", "sun",
+    "pelargonium", "bishop of llandaff", "gaura", "geranium",
+    "orange dahlia", "pink-yellow dahlia", "cautleya spicata",
+    "japanese anemone", "black-eyed susan", "silverbush",
+    "californian poppy", "osteospermum", "spring crocus",
+    "bearded iris", "wind", "tree poppy", "gazania",
+    "azalea", "water lily", "rose", "thorn apple",
+    "morning glory", "passion", "lotus", "toad lily",
+    "anthurium", "frangipani", "clematis", "hibiscus",
+    "columbine", "desert-rose", "tree mallow", "magnolia",
+    "cyclamen", "watercress", "canna lily", "hippeastrum",
+    "bee balm", "ball moss", "foxglove", "bougainvillea",
+    "camellia", "mallow", "mexican petunia", "bromelia",
+    "blanket", "trumpet creeper", "blackberry lily",
+]
+
+CAPTION_TEMPLATES = [
+    "a beautiful {flower} flower",
+    "a {flower} flower with detailed petals",
+    "a fresh {flower} flower",
+    "a close-up of a {flower} flower",
+    "a stunning {flower} in bloom",
+    "{flower} petals in detail",
+    "a lovely {flower} flower photograph",
+    "beautiful {flower} with vibrant colors",
+]
+
+BATCH_SIZE = 64
+
+
+def seed_prompt_cache():
+    generator = ImageGenerator()
+    generator.load_text_encoder()
+
+    if generator.prompt_cache.disk_dir is None:
+        print("✗ Persistent prompt cache is disabled (app_config.prompt_cache_subdir is None)")
+        return
+
+    prompts = [t.format(flower=f) for f in OFFICIAL_FLOWER_NAMES for t in CAPTION_TEMPLATES]
+    print(f"Encoding {len(prompts)} prompts...")
+    for i in range(0, len(prompts), BATCH_SIZE):
+        generator.encode_text(prompts[i:i + BATCH_SIZE])
+
+    stats = generator.prompt_cache.stats()
+    print(f"✓ {stats['misses']} new, {stats['disk_hits']} already cached -> {stats['disk_dir']}")
+
+
+if __name__ == "__main__":
+    seed_prompt_cache()
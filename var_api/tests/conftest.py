@@ -0,0 +1,38 @@
+# ===== tests/conftest.py =====
+
+import os
+import sys
+from typing import Optional
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.models import VQVAE, VAR
+
+# Small enough to run on CPU in well under a second per generation
+PATCH_NUMS = (1, 2, 3, 4)
+
+
+def build_tiny_var(compute_dtype: Optional[torch.dtype] = None) -> VAR:
+    """Randomly initialized VAR (and its VQVAE) over a short patch schedule, same weights every call"""
+    torch.manual_seed(0)
+    vae = VQVAE(
+        vocab_size=512, z_channels=8, ch=32, v_patch_nums=PATCH_NUMS, inference_only=True, 
+        compute_dtype=compute_dtype
+    )
+    return VAR(
+        vae, n_cond_embed=48, depth=3, embed_dim=64, num_heads=4, drop_path_rate=0., 
+        patch_nums=PATCH_NUMS, attn_backend='sdpa', inference_only=True, compute_dtype=compute_dtype
+    )
+
+
+@pytest.fixture
+def tiny_var() -> VAR:
+    return build_tiny_var()
+
+
+@pytest.fixture
+def tiny_var_factory():
+    return build_tiny_var
@@ -0,0 +1,63 @@
+# ===== tests/test_attention.py =====
+
+"""The fused 'sdpa' attention backend against the explicit 'math' one"""
+
+import pytest
+import torch
+
+from app.models.components import KVCache, SelfAttention
+
+EMBED_DIM, NUM_HEADS = 64, 4
+STAGES = (1, 4, 9)  # tokens per stage, as in a (1, 2, 3) patch schedule
+
+
+def _block_causal_bias(stages) -> torch.Tensor:
+    """Additive bias letting each token attend to its own and earlier stages"""
+    lvl = torch.cat([torch.full((n,), i) for i, n in enumerate(stages)])
+    return torch.where(lvl[:, None] >= lvl[None, :], 0., -torch.inf).view(1, 1, len(lvl), len(lvl))
+
+
+def _attention_pair(attn_l2_norm: bool):
+    torch.manual_seed(0)
+    math_attn = SelfAttention(EMBED_DIM, NUM_HEADS, attn_l2_norm=attn_l2_norm, attn_backend='math').eval()
+    sdpa_attn = SelfAttention(EMBED_DIM, NUM_HEADS, attn_l2_norm=attn_l2_norm, attn_backend='sdpa').eval()
+    with torch.no_grad():
+        math_attn.q_bias.normal_()
+        math_attn.v_bias.normal_()
+    sdpa_attn.load_state_dict(math_attn.state_dict())
+    return math_attn, sdpa_attn
+
+
+@pytest.mark.parametrize("attn_l2_norm", [True, False])
+def test_block_causal_pass_with_bias(attn_l2_norm):
+    math_attn, sdpa_attn = _attention_pair(attn_l2_norm)
+    B, head_dim, L = 2, EMBED_DIM // NUM_HEADS, sum(STAGES)
+    x = torch.randn(B, L, EMBED_DIM)
+    bias = _block_causal_bias(STAGES)
+    
+    with torch.no_grad():
+        out_math = math_attn(x, bias, KVCache(B, NUM_HEADS, L, head_dim), 0)
+        out_sdpa = sdpa_attn(x, bias, KVCache(B, NUM_HEADS, L, head_dim), 0)
+    torch.testing.assert_close(out_sdpa, out_math, atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize("attn_l2_norm", [True, False])
+@pytest.mark.parametrize("frozen", [False, True])
+def test_stagewise_with_kv_cache(attn_l2_norm, frozen):
+    math_attn, sdpa_attn = _attention_pair(attn_l2_norm)
+    if frozen:
+        math_attn.freeze()
+        sdpa_attn.freeze()
+    B, head_dim, L = 2, EMBED_DIM // NUM_HEADS, sum(STAGES)
+    caches = [KVCache(B, NUM_HEADS, L, head_dim) for _ in range(2)]
+    
+    start = 0
+    with torch.no_grad():
+        for n in STAGES:
+            x = torch.randn(B, n, EMBED_DIM)
+            out_math = math_attn(x, None, caches[0], start)
+            out_sdpa = sdpa_attn(x, None, caches[1], start)
+            torch.testing.assert_close(out_sdpa, out_math, atol=1e-5, rtol=1e-4)
+            start += n
+    torch.testing.assert_close(caches[1].k, caches[0].k)
+    torch.testing.assert_close(caches[1].v, caches[0].v)
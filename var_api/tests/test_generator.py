@@ -0,0 +1,42 @@
+# ===== tests/test_generator.py =====
+
+import pytest
+
+from app.config import app_config, model_config
+from app.services.generator import ImageGenerator
+
+
+def test_sample_count():
+    assert ImageGenerator.sample_count(3, None) == 3
+    assert ImageGenerator.sample_count(3, 7) == 3
+    assert ImageGenerator.sample_count(1, [5, 6]) == 2
+    assert ImageGenerator.sample_count(2, [5, 6]) == 2
+    
+    with pytest.raises(ValueError):
+        ImageGenerator.sample_count(3, [5, 6])
+    with pytest.raises(ValueError):
+        ImageGenerator.sample_count(0, None)
+    with pytest.raises(ValueError):
+        ImageGenerator.sample_count(app_config.max_batch_size + 1, None)
+
+
+def test_sample_seeds():
+    generator = ImageGenerator()
+    assert generator._sample_seeds(10, 3) == [10, 11, 12]
+    assert generator._sample_seeds([4, 2], 1) == [4, 2]
+    seeds = generator._sample_seeds([None, 9], 2)
+    assert len(seeds) == 2 and seeds[1] == 9 and isinstance(seeds[0], int)
+    assert len(generator._sample_seeds(None, 4)) == 4
+
+
+def test_model_version_tracks_output_settings(monkeypatch):
+    generator = ImageGenerator()
+    monkeypatch.setattr(app_config, 'vae_channels_last', False)
+    base = generator.model_version
+    
+    monkeypatch.setattr(model_config, 'var_cfg_schedule', (0, 0, 0.5, 1, 1, 1, 1, 1, 1, 1))
+    with_schedule = generator.model_version
+    assert with_schedule != base
+    
+    monkeypatch.setattr(model_config, 'var_dtype', 'bfloat16')
+    assert generator.model_version not in (base, with_schedule)
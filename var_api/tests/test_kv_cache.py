@@ -0,0 +1,24 @@
+# ===== tests/test_kv_cache.py =====
+
+import torch
+
+from app.models import KVCachePool
+
+
+def test_pool_keeps_one_set_for_all_batch_sizes():
+    pool = KVCachePool(num_layers=2, num_heads=2, max_len=5, head_dim=4)
+    for batch_size in (2, 8, 4, 1, 8, 6):
+        with pool.borrow(batch_size, 'cpu') as caches:
+            assert len(caches) == 2
+            assert caches[0].k.shape == (batch_size, 2, 5, 4)
+    
+    idle = pool._idle[(torch.device('cpu'), torch.float32)]
+    assert len(idle) == 1
+    assert idle[0][0].k.shape[0] == 8
+
+
+def test_concurrent_borrows_get_separate_buffers():
+    pool = KVCachePool(num_layers=1, num_heads=1, max_len=3, head_dim=2, max_idle=1)
+    with pool.borrow(2, 'cpu') as first, pool.borrow(2, 'cpu') as second:
+        assert first[0].k.data_ptr() != second[0].k.data_ptr()
+    assert sum(len(sets) for sets in pool._idle.values()) == 1
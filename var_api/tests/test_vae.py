@@ -0,0 +1,36 @@
+# ===== tests/test_vae.py =====
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from app.config import model_config
+from app.models.vae import VectorQuantizer2
+
+# Max abs difference allowed (the matrices are stored in the model's float32)
+TOLERANCE = 1e-5
+
+
+@pytest.fixture(scope="module")
+def quantizer() -> VectorQuantizer2:
+    quantizer = VectorQuantizer2(
+        model_config.vocab_size, model_config.Cvae, 
+        v_patch_nums=model_config.patch_nums, inference_only=True
+    )
+    quantizer.freeze_for_inference()
+    return quantizer
+
+
+@pytest.mark.parametrize("si", range(len(model_config.patch_nums)))
+def test_resize_matrices_match_interpolate(quantizer, si):
+    pn, HW = model_config.patch_nums[si], model_config.patch_nums[-1]
+    torch.manual_seed(si)
+    h = torch.randn(4, model_config.Cvae, pn, pn)
+    f = torch.randn(4, model_config.Cvae, HW, HW)
+    
+    torch.testing.assert_close(
+        quantizer.upsample(h, si), F.interpolate(h, size=(HW, HW), mode='bicubic'), atol=TOLERANCE, rtol=0
+    )
+    torch.testing.assert_close(
+        quantizer.downsample(f, si), F.interpolate(f, size=(pn, pn), mode='area'), atol=TOLERANCE, rtol=0
+    )
@@ -0,0 +1,74 @@
+# ===== tests/test_var.py =====
+
+import torch
+
+
+def test_freeze_packs_ada_lin(tiny_var):
+    linears = [block.ada_lin[1] for block in tiny_var.blocks] + [tiny_var.head_nm.ada_lin[1]]
+    weights = [l.weight.clone() for l in linears]
+    cond = torch.randn(2, tiny_var.D)
+    
+    with torch.no_grad():
+        unfrozen = tiny_var._compute_modulation(cond)
+        tiny_var.freeze_for_inference()
+        frozen = tiny_var._compute_modulation(cond)
+    
+    # Inference-only: the per-layer weights are views of the packed buffer, not copies
+    packed = tiny_var.frozen_ada_weight.untyped_storage().data_ptr()
+    for l, w in zip(linears, weights):
+        assert torch.equal(l.weight, w)
+        assert l.weight.untyped_storage().data_ptr() == packed
+    for block, mods, frozen_mods in zip(tiny_var.blocks, unfrozen[0], frozen[0]):
+        expected = block.ada_lin(cond).view(-1, 1, 6, tiny_var.C).unbind(2)
+        for a, b, c in zip(mods, frozen_mods, expected):
+            torch.testing.assert_close(a, c)
+            torch.testing.assert_close(b, c)
+
+
+def test_generate_is_deterministic_per_seed(tiny_var):
+    tiny_var.freeze_for_inference()
+    embed = torch.randn(2, 48)
+    first = tiny_var.generate(embed, cfg=2.0, top_k=50, top_p=0.9, seed=[3, 4])
+    second = tiny_var.generate(embed, cfg=2.0, top_k=50, top_p=0.9, seed=[3, 4])
+    assert first.shape == (2, 3, 64, 64)
+    assert torch.equal(first, second)
+
+
+def test_seed_gives_same_image_alone_and_in_a_batch(tiny_var):
+    tiny_var.freeze_for_inference()
+    torch.manual_seed(1)
+    embed = torch.randn(8, 48)
+    cfg = torch.linspace(1.0, 4.0, 8)
+    seeds = list(range(100, 108))
+    
+    batch_images, batch_tokens = tiny_var.generate(
+        embed, cfg=cfg, top_k=50, top_p=0.9, seed=seeds, return_tokens=True
+    )
+    for i in (0, 5):
+        images, tokens = tiny_var.generate(
+            embed[i:i + 1], cfg=cfg[i].item(), top_k=50, top_p=0.9, seed=seeds[i], return_tokens=True
+        )
+        for stage_tokens, stage_batch_tokens in zip(tokens, batch_tokens):
+            assert torch.equal(stage_tokens[0], stage_batch_tokens[i])
+        torch.testing.assert_close(images[0], batch_images[i], atol=1e-5, rtol=0)
+
+
+def test_uncond_prefix_is_reused_when_cond_rows_miss(tiny_var):
+    tiny_var.freeze_for_inference()
+    torch.manual_seed(2)
+    warm, embed = torch.randn(1, 48), torch.randn(2, 48)
+    kwargs = dict(cfg=3.0, top_k=50, top_p=0.9, seed=[7, 8], return_tokens=True)
+    
+    expected_images, expected_tokens = tiny_var.generate(embed, **kwargs)
+    tiny_var.prefix_cache.clear()
+    tiny_var.generate(warm, cfg=3.0, seed=0)
+    
+    restored = []
+    restore = tiny_var._restore_uncond_prefix
+    tiny_var._restore_uncond_prefix = lambda *args: restored.append(1) or restore(*args)
+    images, tokens = tiny_var.generate(embed, **kwargs)
+    
+    assert restored
+    for stage_tokens, stage_expected in zip(tokens, expected_tokens):
+        assert torch.equal(stage_tokens, stage_expected)
+    torch.testing.assert_close(images, expected_images, atol=1e-5, rtol=0)